@@ -0,0 +1,209 @@
+# columnar (Parquet/Feather) export of session data with a consistent
+# schema and a lab-wide index of exported sessions
+#
+# example:
+# --------
+# export_session(db_c.to_df(), exp['data'], 'S01', 1, 'c')
+# df = load_dataset(exp['data'], parts=['c'])
+from __future__ import absolute_import
+
+import os
+import re
+import time
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from trialdata import FileLock
+
+
+# columns of exported data and their types (missing columns are filled
+# with the values in ``_fill_values``)
+schema = [('subject', 'object'), ('session', 'int32'), ('part', 'object'),
+          ('trial', 'int32'), ('trial_type', 'object'), ('step', 'int32'),
+          ('opacity', 'float64'), ('orientation', 'int32'),
+          ('response', 'object'), ('RT', 'float64'), ('ifcorrect', 'int32'),
+          ('time', 'float64'), ('fixTime', 'int32'), ('targetTime', 'int32'),
+          ('SMI', 'int32'), ('maskTime', 'int32'), ('targetDur', 'float64'),
+          ('SMIDur', 'float64'), ('droppedFrames', 'int32'),
+          ('timingError', 'int32')]
+_fill_values = dict(step=0, opacity=np.nan, orientation=0, response='',
+                    RT=np.nan, ifcorrect=0, time=np.nan, fixTime=0,
+                    targetTime=0, SMI=0, maskTime=0, targetDur=np.nan,
+                    SMIDur=np.nan, droppedFrames=0, timingError=0)
+
+# trial type of parts that do not record it
+part_trial_types = dict(a='training', c='main c')
+
+# index lists file names relative to the data directory, so that the
+# directory can be moved or shared
+index_name = 'dataset_index.parquet'
+index_columns = ['subject', 'session', 'part', 'file', 'n_trials',
+                 'exported']
+valid_formats = ('parquet', 'feather')
+
+
+def to_schema(df, subject, session, part):
+    '''Convert trial DataFrame (training, fitting or part c) to the common
+    schema.'''
+    df = df.reset_index(drop=True)
+    n_trials = df.shape[0]
+    columns = dict()
+    for col, dtype in schema:
+        if col in df.columns:
+            values = df[col].values
+        elif col == 'subject':
+            values = np.full(n_trials, str(subject), dtype='object')
+        elif col == 'session':
+            values = np.full(n_trials, session)
+        elif col == 'part':
+            values = np.full(n_trials, part, dtype='object')
+        elif col == 'trial':
+            values = np.arange(1, n_trials + 1)
+        elif col == 'trial_type':
+            values = np.full(n_trials, part_trial_types.get(part, ''),
+                             dtype='object')
+        else:
+            values = np.full(n_trials, _fill_values[col])
+        if dtype == 'object':
+            values = np.array([str(val) for val in values], dtype='object')
+        columns[col] = np.asarray(values).astype(dtype)
+    return pd.DataFrame(columns, columns=[col for col, _ in schema])
+
+
+def session_path(data_dir, subject, session, part, fmt='parquet'):
+    return os.path.join(data_dir, '{}_{}_{}.{}'.format(subject, part, session,
+                                                        fmt))
+
+
+def export_session(df, data_dir, subject, session, part, fmt='parquet',
+                   update_index=True):
+    '''Write session data in a columnar format and add it to the index.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Trials of one part of the session (for example
+        ``TrialRecorder.to_df()``).
+    data_dir : str
+        Data directory (``exp['data']``), the index is kept there too.
+    subject : str
+        Subject ID.
+    session : int
+        Session number (the number ``DataManager.give_path`` uses).
+    part : str
+        Part of the procedure: ``'a'`` - training, ``'b'`` - contrast
+        fitting, ``'c'`` - main part.
+    fmt : str
+        ``'parquet'`` or ``'feather'``.
+    update_index : bool
+        Whether to add the session to the index.
+
+    Returns
+    -------
+    path : str
+        Path of the written file.
+    '''
+    if fmt not in valid_formats:
+        raise ValueError('fmt must be one of {}, got {} '
+                         'instead.'.format(valid_formats, fmt))
+    data = to_schema(df, subject, session, part)
+    path = session_path(data_dir, subject, session, part, fmt=fmt)
+    _atomic_write(data, path, fmt)
+
+    if update_index:
+        fname = os.path.basename(path)
+        entry = pd.DataFrame([[str(subject), session, part, fname,
+                               data.shape[0], time.time()]],
+                             columns=index_columns)
+        # the index is shared by all stations - lock it while updating
+        with _index_lock(data_dir):
+            index = read_index(data_dir)
+            if index.shape[0] > 0:
+                index = index[index.file != fname]
+            index = pd.concat([index, entry], ignore_index=True)
+            _atomic_write(index, os.path.join(data_dir, index_name),
+                          'parquet')
+    return path
+
+
+def _index_lock(data_dir):
+    return FileLock(os.path.join(data_dir, index_name + '.lock'))
+
+
+def _atomic_write(df, path, fmt):
+    # write to a temporary file first so that readers never see
+    # a partially written file (unique name, so that concurrent writers
+    # do not overwrite each other's temporary files)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    if fmt == 'parquet':
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_feather(tmp_path)
+    if os.name == 'nt' and os.path.exists(path):
+        # rename does not overwrite files on Windows
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def read_index(data_dir):
+    '''Index of exported sessions (empty DataFrame if there is none).'''
+    path = os.path.join(data_dir, index_name)
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=index_columns)
+    return pd.read_parquet(path)
+
+
+def rebuild_index(data_dir):
+    '''Recreate the index from exported files present in ``data_dir``.'''
+    pattern = r'(.+)_([abc])_([0-9]+)\.({})$'.format('|'.join(valid_formats))
+    rows = list()
+    for fl in sorted(os.listdir(data_dir)):
+        match = re.match(pattern, fl)
+        if match is None:
+            continue
+        subject, part, session, fmt = match.groups()
+        path = os.path.join(data_dir, fl)
+        n_trials = _read_file(path).shape[0]
+        rows.append([subject, int(session), part, fl, n_trials,
+                     os.path.getmtime(path)])
+    index = pd.DataFrame(rows, columns=index_columns)
+    with _index_lock(data_dir):
+        _atomic_write(index, os.path.join(data_dir, index_name), 'parquet')
+    return index
+
+
+def _read_file(path, columns=None):
+    if path.endswith('.feather'):
+        return pd.read_feather(path, columns=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+def load_dataset(data_dir, parts=None, subjects=None, columns=None):
+    '''Load exported sessions listed in the index as one DataFrame.
+
+    Parameters
+    ----------
+    data_dir : str
+        Data directory with the index.
+    parts : list of str | None
+        Parts to load (``'a'``, ``'b'``, ``'c'``), all by default.
+    subjects : list of str | None
+        Subjects to load, all by default.
+    columns : list of str | None
+        Columns to read, all by default.
+    '''
+    index = read_index(data_dir)
+    if parts is not None:
+        index = index[index.part.isin(parts)]
+    if subjects is not None:
+        index = index[index.subject.isin([str(s) for s in subjects])]
+    if index.shape[0] == 0:
+        return to_schema(pd.DataFrame(), '', 0, '')
+    return pd.concat([_read_file(os.path.join(data_dir, fname),
+                                 columns=columns)
+                      for fname in index.file], ignore_index=True)
@@ -2,7 +2,14 @@
 
 import os
 import re
+import json
 import yaml
+import threading
+import traceback
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 import numpy  as np
 import pandas as pd
@@ -11,6 +18,9 @@ from psychopy import visual, event, gui, core
 from PIL      import Image
 from utils    import round2step, trim_df
 from gui import Button, ClickScale, Interface
+from trialdata import (create_database, ms2frames, TrialRecorder,
+					   frame_phases, frame_columns, FrameTimer, TrialJournal,
+					   read_journal, FileLock)
 
 
 def plot_Feedback(stim, plotter, pth, resize=1.0, plotter_args={},
@@ -108,9 +118,12 @@ class ExperimenterInfo(Interface):
 		self.update_text(texts, image=False)
 
 	def experimenter_plot(self, img_name):
+		# img_name can be an image file or PIL Image (rendered in memory)
 		try:
 			self.image.setImage(img_name)
-			img_size = np.array(Image.open(img_name).size)
+			img = (img_name if isinstance(img_name, Image.Image)
+				   else Image.open(img_name))
+			img_size = np.array(img.size)
 			self.image.size = img_size # np.round(imgsize * resize)
 			self.refresh(image=True)
 		except:
@@ -164,90 +177,70 @@ class AnyQuestionsGUI(Interface):
 			core.wait(0.15)
 
 
-# TODO
-# - [ ] add some of functionality below to chainsaw
-def create_database(exp, trials=None, rep=None, combine_with=None,
-					shuffle_in_reps=False, numerate_steps=False):
-	# define column names:
-	column_names = ['time', 'fixTime', 'targetTime', 'SMI', 'maskTime',
-					'opacity', 'orientation', 'response', 'ifcorrect', 'RT']
-	from_exp = ['targetTime', 'SMI', 'maskTime']
-	if numerate_steps:
-		column_names = column_names[:6] + ['step'] + column_names[6:]
-
-	# combined columns
-	cmb = ['orientation']
-
-	# how many times each combination should be presented
-	if not trials and not rep:
-		trials = 140
-
-	# generate all trial combinations
-	if not combine_with:
-		lst = exp['orientation']
-		trials_in_rep = len(lst)
-		num_rep = (int(rep) if not rep is None else
-				   int(np.ceil(trials / float(len(lst)))))
-		lst = np.reshape(np.array(lst * num_rep), (-1, 1))
-	else:
-		cmb.append(combine_with[0])
-		lst = [[o, x] for o in exp['orientation'] for x in combine_with[1]]
-		trials_in_rep = len(lst)
-		num_rep = (int(rep) if not rep is None else
-				   int(np.ceil(trials / float(len(lst)))))
-		lst = np.array(lst * num_rep)
-
-	# turn to array and shuffle rows, then construct dataframe
-	if shuffle_in_reps:
-		for rp in range(num_rep):
-			idx1 = rp * trials_in_rep
-			idx2 = (rp + 1) * trials_in_rep
-			lst[idx1:idx2] = np.random.permutation(lst[idx1:idx2])
-	else:
-		np.random.shuffle(lst)
-
-	db = pd.DataFrame(index=np.arange(1, lst.shape[0] + 1), columns=column_names)
-
-	num_trials = db.shape[0]
-	if not trials:
-		trials = num_trials
-
-	# fill the data frame from lst
-	for i, r in enumerate(cmb):
-		db[r] = lst[:, i]
-
-	# add fix time in frames
-	if 'fixTime' not in cmb:
-		time_limits = exp['fixTimeLim']
-		fix_ms = np.random.uniform(low=time_limits[0], high=time_limits[1],
-								   size=num_trials) * 1000
-		db['fixTime'] = ms2frames(fix_ms, exp['frm']['time'])
-
-	# fill relevant columns from exp:
-	for col in from_exp:
-		db[col] = exp[col][0]
-
-	# numerate steps
-	if numerate_steps:
-		db.loc[:, 'opacity'] = db.loc[:, 'opacity'].astype('float64')
-		for stp_idx, stp in enumerate(combine_with[1], start=1):
-			mask = db.loc[:, 'opacity'] == stp
-			assert mask.mean() == (1. / len(combine_with[1]))
-			db.loc[mask, 'step'] = stp_idx
-
-	# fill NaNs with zeros:
-	db.fillna(0, inplace=True)
+class BackgroundWriter(object):
+	'''Performs data exports (Excel files, numpy arrays, images) in a single
+	background thread so that writing to disk does not block presentation.
 
-	# make sure types are correct:
-	to_float = ['time', 'opacity', 'RT']
-	to_int = ['ifcorrect', 'fixTime', 'targetTime', 'SMI', 'maskTime']
-	if numerate_steps:
-		to_int.append('step')
-	db.loc[:, to_float + to_int] = db.loc[:, to_float + to_int].fillna(0)
-	db.loc[:, to_float] = db.loc[:, to_float].astype('float64')
-	db.loc[:, to_int] = db.loc[:, to_int].astype('int32')
-
-	return db[0:trials]
+	Tasks are taken from a bounded queue - ``submit`` blocks only when
+	``maxsize`` tasks are waiting. Data passed to the writer must not be
+	modified afterwards (pass copies, for example ``TrialRecorder.to_df()``).
+	Errors are not raised in the background thread but collected and
+	returned by ``errors`` so that they can be logged from the main thread.
+	'''
+	def __init__(self, maxsize=16):
+		self._queue = queue.Queue(maxsize=maxsize)
+		self._errors = list()
+		self._lock = threading.Lock()
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			task = self._queue.get()
+			if task is None:
+				self._queue.task_done()
+				break
+			description, fun, args, kwargs = task
+			try:
+				fun(*args, **kwargs)
+			except Exception:
+				with self._lock:
+					self._errors.append('{} failed:\n{}'.format(
+						description, traceback.format_exc()))
+			self._queue.task_done()
+
+	def submit(self, description, fun, *args, **kwargs):
+		'''Run ``fun(*args, **kwargs)`` in the background thread.'''
+		if not self._thread.is_alive():
+			raise RuntimeError('BackgroundWriter has been closed.')
+		self._queue.put((description, fun, args, kwargs))
+
+	def to_excel(self, df, path):
+		self.submit('writing ' + path, df.to_excel, path)
+
+	def save_array(self, path, arr):
+		self.submit('writing ' + path, np.save, path, np.array(arr))
+
+	def save_image(self, image, path):
+		'''Save PIL Image.'''
+		self.submit('writing ' + path, image.save, path)
+
+	def errors(self):
+		'''Errors that occurred since the last call (list of str).'''
+		with self._lock:
+			errors, self._errors = self._errors, list()
+		return errors
+
+	def wait(self):
+		'''Wait until all submitted tasks are done.'''
+		self._queue.join()
+
+	def close(self):
+		'''Finish all submitted tasks and stop the thread.'''
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
 
 
 def getFrameRate(win, frames=25):
@@ -255,23 +248,6 @@ def getFrameRate(win, frames=25):
 	return dict(rate=frame_rate, time=1000.0 / frame_rate)
 
 
-def ms2frames(times, frame_time):
-	tp = type(times)
-	if isinstance(times, list):
-	    frms = list()
-	    for t in times:
-	        frms.append(int(round(t / frame_time)))
-	elif isinstance(times, dict):
-	    frms = dict()
-	    for t in times.keys():
-	        frms[t] = int(round(times[t] / frame_time))
-	elif isinstance(times, np.ndarray):
-		frms = np.array(np.round(times / frame_time), dtype=int)
-	else:
-		raise ValueError('times has to be list, dict or numpy ndarray.')
-	return frms
-
-
 # get user name:
 def getSubject():
     '''
@@ -288,6 +264,7 @@ def getSubject():
     myDlg.addField('distance (cm)', 95.)
     myDlg.addText('Ustawienia procedury')
     myDlg.addField('debug mode:', choices=['False', 'True'])
+    myDlg.addField('resume session:', choices=['False', 'True'])
     myDlg.show()  # show dialog and wait for OK or Cancel
 
     if myDlg.OK:  # the user pressed OK
@@ -299,7 +276,13 @@ def getSubject():
 
 
 class DataManager(object):
-	'''manges data paths for the experiment - avoiding overwrites etc.'''
+	'''manges data paths for the experiment - avoiding overwrites etc.
+
+	Numbers of allocated paths are kept in a manifest next to the ID file
+	(``ID_manifest.json``), the data directory is scanned only once - when
+	the manifest is created. The manifest is updated under a lock file so
+	two processes never get the same path.
+	'''
 	def __init__(self, exp):
 		self.keymap = exp['keymap']
 		self.choose_resp = exp['choose_resp']
@@ -309,6 +292,7 @@ class DataManager(object):
 		self.path = dict()
 		self.path['data'] = exp['data']
 		self.path['ID'] = os.path.join(self.path['data'], self.ID)
+		self.path['manifest'] = self.path['ID'] + '_manifest.json'
 
 		# check if such subject has been created
 		# if so - read keymap
@@ -320,7 +304,7 @@ class DataManager(object):
 
 	def read(self):
 		with open(self.path['ID'], 'r') as f:
-			data = yaml.load(f)
+			data = yaml.safe_load(f)
 		self.keymap = data['key-mapping']
 		self.sex = data['sex']
 
@@ -328,26 +312,58 @@ class DataManager(object):
 		if path_type in self.path and self.path[path_type]:
 			return self.path[path_type]
 		else:
-			pattern = self.ID + '_{}_([0-9]+)\.'.format(path_type) + file_ending
-			def get_repval(pattern, s):
-				r = re.search(pattern, s)
-				return int(r.groups()[0]) if r else 0
-			fls = os.listdir(self.path['data'])
-			self.val[path_type] = max([get_repval(pattern, s) for s in fls]) + 1
+			self.val[path_type] = self.allocate(path_type)
 			self.path[path_type] = os.path.join(self.path['data'], self.ID +
 				'_{}_{}.'.format(path_type, self.val[path_type]) + file_ending)
 			return self.path[path_type]
 
+	def allocate(self, path_type):
+		'''Allocate next number for given path type in the manifest.'''
+		with FileLock(self.path['manifest'] + '.lock'):
+			manifest = self.read_manifest()
+			val = manifest['counters'].get(path_type, 0) + 1
+			manifest['counters'][path_type] = val
+			tmp_path = self.path['manifest'] + '.tmp'
+			with open(tmp_path, 'w') as f:
+				json.dump(manifest, f, indent=1, sort_keys=True)
+			if os.name == 'nt' and os.path.exists(self.path['manifest']):
+				# rename does not overwrite files on Windows
+				os.remove(self.path['manifest'])
+			os.rename(tmp_path, self.path['manifest'])
+		return val
+
+	def read_manifest(self):
+		'''Read manifest (numbers of allocated paths for each path type). If
+		there is no manifest, numbers are taken from files present in the
+		data directory.'''
+		if os.path.isfile(self.path['manifest']):
+			with open(self.path['manifest'], 'r') as f:
+				return json.load(f)
+
+		pattern = re.escape(self.ID) + '_(.+)_([0-9]+)\.[^.]+$'
+		counters = dict()
+		for fl in os.listdir(self.path['data']):
+			r = re.match(pattern, fl)
+			if r:
+				path_type, val = r.groups()
+				counters[path_type] = max(counters.get(path_type, 0),
+										  int(val))
+		return dict(ID=self.ID, counters=counters)
+
 	def give_previous_path(self, path_type, file_ending='xls'):
+		'''Path of the latest existing file of given type preceding the
+		current path ('' if there is none). Allocated paths are not always
+		written (for example when a session is resumed), so the latest
+		existing file is looked for.'''
 		# make sure current path was checked
 		self.give_path(path_type, file_ending=file_ending)
 		# get previous:
-		prev_val = self.val[path_type] - 1
-		if prev_val == 0:
-			return ''
-		else:
-			return os.path.join(self.path['data'], self.ID + '_{}_{}.'.format(
+		for prev_val in range(self.val[path_type] - 1, 0, -1):
+			pth = os.path.join(self.path['data'], self.ID + '_{}_{}.'.format(
 				path_type, prev_val) + file_ending)
+			if os.path.isfile(pth):
+				return pth
+		return ''
 
 	def write(self):
 		save_data = {'ID': self.ID, 'sex': self.sex,
@@ -35,7 +35,7 @@ shaders.fragFBOtoFrame = fragFBOtoFramePatched
 # other imports
 # -------------
 from psychopy  import visual, core, event, logging
-from psychopy.data import QuestHandler, StairHandler
+from psychopy.data import QuestHandler
 
 import os
 import time
@@ -58,15 +58,23 @@ if __name__ == '__main__' and __package__ is None:
 
 from .baseline import run as run_baseline
 from .exputils  import (plot_Feedback, create_database, DataManager,
-                        ExperimenterInfo, AnyQuestionsGUI)
-from .weibull   import (Weibull, QuestPlus, weibull_db, PsychometricMonkey,
-                        init_thresh_optim, from_db, to_db, weibull)
+                        ExperimenterInfo, AnyQuestionsGUI, TrialRecorder,
+                        TrialJournal, BackgroundWriter, FrameTimer,
+                        frame_columns)
+from .weibull   import (Weibull, weibull_db, PsychometricMonkey,
+                        init_thresh_optim, to_db)
+from .procedure import (create_staircase, create_quest_plus, get_contrasts,
+                        plan_contrasts, update_contrast_steps,
+                        apply_contrast_steps, stages, load_session,
+                        session_trials, replay_staircase, main_c_plan,
+                        restore_main_c, corrs)
 from .utils     import to_percent, trim_df
 from .stimutils import (exp, db, stim, present_trial, present_break,
     show_resp_rules, textscreen, present_feedback, present_training,
     give_training_db, Instructions, onflip_work, clear_port, break_checker,
     forced_break, final_info)
 from .viz import plot_quest_plus, plot_threshold_entropy
+from .dataset import export_session
 
 if exp['use trigger']:
     from ctypes import windll
@@ -83,6 +91,38 @@ log_path = dm.give_path('l', file_ending='log')
 lg = logging.LogFile(f=log_path, level=logging.WARNING, filemode='w')
 subj_id = exp['participant']['ID']
 
+# every trial is appended to the journal, full data files are written
+# only at the end of each part; state records (contrast steps, order of
+# part c trials) allow to resume an interrupted session
+session = None
+journal_path = dm.give_path('j', file_ending='jsonl')
+state_path = dm.give_path('s', file_ending='jsonl')
+if exp['resume']:
+    previous_paths = [dm.give_previous_path('j', file_ending='jsonl'),
+                      dm.give_previous_path('s', file_ending='jsonl')]
+    session = load_session(*previous_paths)
+    if session is not None:
+        journal_path, state_path = previous_paths
+        lg.write('Resuming session from {}, stage: {}\n'.format(
+            journal_path, stages[session['stage']]))
+resume_stage = -1 if session is None else session['stage']
+journal = TrialJournal(journal_path, fsync_every=exp['journal fsync every'])
+states = TrialJournal(state_path, fsync_every=exp['journal fsync every'])
+
+# data exports and break plots are written in a background thread
+writer = BackgroundWriter()
+
+# flip timestamps of every trial are recorded, trials with target or SMI
+# duration different than planned are flagged (timingError) and logged
+timer = FrameTimer(exp['frm']['time'])
+
+def export_part(df, part):
+    '''Export trials of given part to Excel and to the lab dataset.'''
+    writer.to_excel(df, dm.give_path(part))
+    writer.submit('exporting part {}'.format(part), export_session, df,
+                  exp['data'], subj_id, dm.val[part], part,
+                  fmt=exp['export format'])
+
 monkey = None
 if exp['debug']:
     resp_mapping = exp['keymap']
@@ -113,9 +153,10 @@ if exp['run baseline1']:
 
 # INSTRUCTIONS
 # ------------
-if exp['run instruct']:
-    instr = Instructions(r'instr\instructions.yaml', auto=exp['debug'],
-                         exp_info=exp_info)
+# a resumed session shows only instructions of parts not started yet
+instr = Instructions(r'instr\instructions.yaml', auto=exp['debug'],
+                     exp_info=exp_info)
+if exp['run instruct'] and session is None:
     instr.present(stop=8)
     show_resp_rules(exp=exp, text=u"Tak wygląda ekran przerwy.",
                     auto=exp['debug'])
@@ -133,11 +174,10 @@ show_resp_rules(exp=exp, text=msg, auto=exp['debug'])
 
 # TRAINING
 # --------
-if exp['run training']:
+if exp['run training'] and resume_stage <= stages.index('training'):
 
     # signal onset of training
     general_trigger(exp['port'], 'training')
-    train_pth = dm.give_path('a')
 
     # set things up
     slow = exp.copy()
@@ -157,7 +197,8 @@ if exp['run training']:
         df, current_corr, contrast = present_training(
             trial, train_db, exp=slow, slowdown=slowdown, corr=corr,
             monkey=monkey, exp_info=exp_info, contrast=contrast,
-            block_num=[current_block, num_training_blocks])
+            block_num=[current_block, num_training_blocks], journal=journal,
+            timer=timer)
         current_block += 1
 
         # update experimenter info:
@@ -181,7 +222,7 @@ if exp['run training']:
         # save training database:
         df_train_save = pd.concat(df_train)
         df_train_save.reset_index(drop=True, inplace=True)
-        df_train_save.to_excel(train_pth)
+        export_part(df_train_save, 'a')
 
 
 # Contrast fitting
@@ -190,27 +231,34 @@ if exp['run training']:
 omit_first_fitting_steps = exp['start at thresh fitting'] and exp['debug']
 if exp['run fitting'] and not omit_first_fitting_steps:
     # some instructions
-    if exp['run instruct']:
+    if exp['run instruct'] and resume_stage < stages.index('staircase'):
         instr.present(stop=15)
 
     # send start trigger:
     general_trigger(exp['port'], 'fitting')
 
-    # init fitting db
-    fitting_db = give_training_db(db, slowdown=1)
+    # init fitting db (with trials of the resumed session)
+    fitting_db = TrialRecorder(give_training_db(db, slowdown=1),
+                               extra_columns=dict(trial_type='object',
+                                                  **frame_columns))
+    fitting_trials = session_trials(session, stages[1:4])
+    fitting_db.fill(fitting_trials)
+    current_trial = fitting_trials.shape[0] + 1
 
     # Staircase
     # ---------
     # we start with staircase to make sure subjects familiarize themselves
     # with adapting contrast regime before the main fitting starts
-    current_trial = 1
     max_trials = exp['staircase trials']
-    staircase = StairHandler(0.8, nTrials=max_trials, nUp=1, nDown=2,
-                             nReversals=6, minVal=0.01, maxVal=2.,
-                             stepSizes=[0.1, 0.1, 0.05, 0.05, 0.025, 0.025],
-                             stepType='lin')
+    staircase = create_staircase(max_trials)
+    replay_staircase(staircase, session_trials(
+        session, ['staircase']).ifcorrect.values)
 
     for contrast in staircase:
+        # resumed session is past the staircase
+        if resume_stage > stages.index('staircase'):
+            break
+
         # never go longer than 35 trials
         if current_trial > 35:
            break
@@ -218,19 +266,19 @@ if exp['run fitting'] and not omit_first_fitting_steps:
         exp_info.blok_info(u'procedura schodkowa', [current_trial, max_trials])
         core.wait(0.5) # fixed pre-fix interval
         present_trial(current_trial, db=fitting_db, contrast=contrast, exp=exp,
-                      monkey=monkey)
+                      monkey=monkey, timer=timer)
         stim['window'].flip()
 
         # set trial type, get response and inform staircase about it
-        fitting_db.loc[current_trial, 'trial_type'] = 'staircase'
-        response = fitting_db.loc[current_trial, 'ifcorrect']
+        fitting_db[current_trial, 'trial_type'] = 'staircase'
+        journal.write_trial(fitting_db, current_trial, stage='staircase',
+                            flips=timer.phase_times())
+        response = fitting_db[current_trial, 'ifcorrect']
         staircase.addResponse(response)
+        states.write(dict(stage='staircase', trial=current_trial))
         current_trial += 1
 
         if current_trial % exp['break after'] == 0:
-            save_db = trim_df(fitting_db)
-            save_db.to_excel(dm.give_path('b'))
-
             # remind about the button press mappings
             show_resp_rules(exp=exp, auto=exp['debug'])
             stim['window'].flip()
@@ -240,35 +288,22 @@ if exp['run fitting'] and not omit_first_fitting_steps:
     # QUEST+
     # ------
 
-    # init quest plus
-    stim_params = from_db(np.arange(-20, 3.1, 0.35)) # -20 dB is about 0.01
-    model_params = [exp['thresholds'], exp['slopes'], exp['lapses']]
-    qp = QuestPlus(stim_params, model_params, function=weibull)
-
-    # find starting contrast
-    start_contrast = staircase._nextIntensity
-    min_idx = np.abs(stim_params - start_contrast).argmin()
-    contrast = stim_params[min_idx]
-
-    # set up priors
-    logfun = lambda x, th, slp: 0.8 / (1 + np.exp(-slp * (x - th))) + 0.2
-    x = np.linspace(0, 1, num=len(model_params[1]))
-    y1 = logfun(x, 0.1, 20)
-    y2 = logfun(x, 0.9, -20)
-    slope_prior = y1 * y2
-    lapse_prior = np.array([1., 1., 1., 1., 0.8, 0.5])
-    threshold_prior = np.ones(len(model_params[0]))
-
-    p1, p2, p3 = np.meshgrid(slope_prior, threshold_prior, lapse_prior)
-    priors = p1 * p2 * p3
-    priors /= priors.sum()
-    qp.posterior = priors.ravel()
+    # init quest plus (with priors), start at staircase contrast
+    qp, contrast = create_quest_plus(exp, staircase._nextIntensity,
+                                     cache_dir=exp['data'])
+
+    # resumed session - update with Quest+ trials presented so far
+    qp_trials = session_trials(session, ['Quest+', 'threshold fitting'])
+    if qp_trials.shape[0] > 0:
+        qp.fit(qp_trials.opacity.values, qp_trials.ifcorrect.values,
+               approximate=True)
+        contrast = qp.next_contrast(axis=exp['QUEST plus axis'])
+    qp_trials_done = min(qp_trials.shape[0], exp['QUEST plus trials'])
 
     # args for break-related stuff
     qp_refresh_rate = sample([3, 4, 5], 1)[0]
     img_name = op.join(exp['data'], '{}_quest_plus_panel.png'.format(subj_id))
     plot_fun = lambda x: plot_quest_plus(x)
-    df_save_path = dm.give_path('b')
 
     # update experimenters view:
     block_name = u'Quest Plus, część I'
@@ -278,52 +313,57 @@ if exp['run fitting'] and not omit_first_fitting_steps:
     show_resp_rules(exp=exp, auto=exp['debug'])
     stim['window'].flip()
 
-    for trial in range(exp['QUEST plus trials']):
+    for trial in range(qp_trials_done, exp['QUEST plus trials']):
         # CHECK if blok_info flips the screen, better if not...
         exp_info.blok_info(block_name, [trial + 1, exp['QUEST plus trials']])
+
+        # next contrast is computed for both responses during the trial
+        qp.precompute_next(contrast, axis=exp['QUEST plus axis'])
         core.wait(0.5) # fixed pre-fix interval
         present_trial(current_trial, db=fitting_db, contrast=contrast, exp=exp,
-                      monkey=monkey)
+                      monkey=monkey, timer=timer)
         stim['window'].flip()
 
         # set trial type, get response and inform staircase about it
-        fitting_db.loc[current_trial, 'trial_type'] = 'Quest+'
-        response = fitting_db.loc[current_trial, 'ifcorrect']
+        fitting_db[current_trial, 'trial_type'] = 'Quest+'
+        journal.write_trial(fitting_db, current_trial, stage='Quest+',
+                            flips=timer.phase_times())
+        response = fitting_db[current_trial, 'ifcorrect']
         qp.update(contrast, response)
-        contrast = qp.next_contrast()
+        contrast = qp.next_contrast(axis=exp['QUEST plus axis'])
+        states.write(dict(stage='Quest+', trial=current_trial))
 
         # check for and perform break-related stuff
         qp_refresh_rate = break_checker(
             stim['window'], exp, fitting_db, exp_info, lg, current_trial,
             qp_refresh_rate=qp_refresh_rate, plot_fun=plot_fun, plot_arg=qp,
-            dpi=120, img_name=img_name, df_save_path=df_save_path)
+            dpi=120, img_name=img_name, writer=writer)
         current_trial += 1
 
     # saving quest may seem unnecessary - posterior can be reproduced
     # from trials, nevertheless it is useful for debugging
     posterior_filename = dm.give_path('posterior', file_ending='npy')
-    np.save(posterior_filename, qp.posterior)
+    writer.save_array(posterior_filename, qp.posterior)
 
-    # forced break
-    forced_break(auto=exp['debug'], exp_info=exp_info)
-    show_resp_rules(exp=exp, auto=exp['debug'])
-    present_break(current_trial, exp=exp, auto=exp['debug'])
+    # forced break (unless resumed session is past it)
+    if resume_stage <= stages.index('Quest+'):
+        forced_break(auto=exp['debug'], exp_info=exp_info)
+        show_resp_rules(exp=exp, auto=exp['debug'])
+        present_break(current_trial, exp=exp, auto=exp['debug'])
 
     # THRESHOLD FITTING
     # -----------------
     block_name = u'Quest Plus, część II'
-    corrs = np.linspace(0.6, 0.9, num=5)
-    def get_contrasts(qp, corrs):
-        weib = Weibull(kind='weibull')
-        weib.params = qp.get_fit_params()
-        return weib.get_threshold(corrs)
-
     contrasts = get_contrasts(qp, corrs)
-    lg.write('Contrast steps after {} trials: {}\n'.format(trial, contrasts))
-    use_contrasts = np.tile(np.asarray(contrasts), 2)
-    np.random.shuffle(use_contrasts)
-
-    trial = 0
+    lg.write('Contrast steps after {} trials: {}\n'.format(
+        exp['QUEST plus trials'], contrasts))
+    plan_start = time.time()
+    use_contrasts = plan_contrasts(qp, contrasts)
+    plan_time = time.time() - plan_start
+
+    # resumed session - finish the interrupted block
+    trial = qp_trials.shape[0] - qp_trials_done
+    use_contrasts = use_contrasts[trial % len(use_contrasts):]
     max_trials = exp['thresh opt trials']
     while trial + 1 <= max_trials:
         for contrast in use_contrasts:
@@ -331,41 +371,53 @@ if exp['run fitting'] and not omit_first_fitting_steps:
             exp_info.blok_info(block_name, [trial + 1, max_trials])
 
             # setup stimulus and present trial
-            core.wait(0.5) # fixed pre-fix interval
+            # (block planning time is included in the pre-fix interval)
+            core.wait(max(0., 0.5 - plan_time)) # fixed pre-fix interval
+            plan_time = 0.
             present_trial(current_trial, db=fitting_db, contrast=contrast,
-                          exp=exp, monkey=monkey)
+                          exp=exp, monkey=monkey, timer=timer)
             stim['window'].flip()
 
             # set trial type, get response and inform staircase about it
-            fitting_db.loc[current_trial, 'trial_type'] = 'Quest+'
-            response = fitting_db.loc[current_trial, 'ifcorrect']
+            fitting_db[current_trial, 'trial_type'] = 'Quest+'
+            journal.write_trial(fitting_db, current_trial,
+                                stage='threshold fitting',
+                                flips=timer.phase_times())
+            response = fitting_db[current_trial, 'ifcorrect']
             qp.update(contrast, response, approximate=True)
+            states.write(dict(stage='threshold fitting', trial=current_trial,
+                              contrasts=contrasts))
 
             # check for and perform break-related stuff
             qp_refresh_rate = break_checker(
                 stim['window'], exp, fitting_db, exp_info, lg, current_trial,
                 qp_refresh_rate=qp_refresh_rate, plot_fun=plot_fun, plot_arg=qp,
-                dpi=120, img_name=img_name, df_save_path=df_save_path)
+                dpi=120, img_name=img_name, writer=writer)
             current_trial += 1
             trial += 1
 
         # after each block of 10 trials (2 * 5 steps) - reevaluate QP
+        plan_start = time.time()
         contrasts = get_contrasts(qp, corrs)
         lg.write('Contrast steps after {} trials: {}\n'.format(
             trial, contrasts))
-        use_contrasts = np.tile(np.asarray(contrasts), 2)
-        np.random.shuffle(use_contrasts)
+        use_contrasts = plan_contrasts(qp, contrasts)
+        plan_time = time.time() - plan_start
+
+    # save fitting trials (a session resumed in part c has already
+    # exported them)
+    if resume_stage < stages.index('main c'):
+        export_part(trim_df(fitting_db.to_df()), 'b')
 
 
 # EXPERIMENT - part c
 # -------------------
 if exp['run main c']:
     # instructions
-    if exp['run instruct']:
+    if exp['run instruct'] and resume_stage < stages.index('main c'):
         instr.present(stop=16)
 
     # get contrast thresholds from quest plus:
-    corrs = np.linspace(0.6, 0.9, num=5)
     contrasts = get_contrasts(qp, corrs)
     lg.write('contrast steps at the beginning of procedure: {}\n'.format(contrasts))
 
@@ -374,8 +426,7 @@ if exp['run main c']:
     img_name = op.join(exp['data'], '{}_final_proc_panel.png'.format(subj_id))
 
     def wb_plot(wb, lst):
-        df = lst[0]
-        df = trim_df(df.copy())
+        df = trim_df(lst[0].to_df())
         wb.x = df.opacity.values.copy()
         wb.y = df.ifcorrect.values.copy()
         wb.orig_y = df.ifcorrect.values.copy()
@@ -384,80 +435,78 @@ if exp['run main c']:
     weib = Weibull(kind='weibull')
     weib.params = qp.get_fit_params()
     plot_fun = lambda x: wb_plot(weib, x)
-    df_save_path = dm.give_path('c')
 
     # 32 repetitions * 4 angles * 5 steps = 640 trials
-    db_c = create_database(exp, combine_with=('opacity', contrasts), rep=32,
-                           shuffle_in_reps=True, numerate_steps=True)
-    exp['numTrials'] = len(db_c.index)
+    db_c = TrialRecorder(create_database(
+        exp, combine_with=('opacity', contrasts), rep=32,
+        shuffle_in_reps=True, numerate_steps=True),
+        extra_columns=frame_columns)
+    exp['numTrials'] = len(db_c)
     contrasts = np.asarray(contrasts)
 
+    # resumed session - restore order of trials, presented trials and
+    # contrast steps, otherwise save order of trials
+    resumed_contrasts, first_trial = restore_main_c(db_c, session)
+    if resumed_contrasts is not None:
+        contrasts = resumed_contrasts
+        main_trials = session_trials(session, ['main c'])
+        qp.fit(main_trials.opacity.values, main_trials.ifcorrect.values,
+               approximate=True)
+    else:
+        states.write(main_c_plan(db_c))
+
     # signal that main proc is about to begin
     general_trigger(exp['port'], 'contrast')
 
     # main loop
-    for i in range(1, db_c.shape[0] + 1):
+    for i in range(first_trial, len(db_c) + 1):
         core.wait(0.5) # pre-fixation time is always the same
-        present_trial(i, exp=exp, db=db_c, monkey=monkey, contrast=None)
+        present_trial(i, exp=exp, db=db_c, monkey=monkey, contrast=None,
+                      timer=timer)
         stim['window'].flip()
 
         # we still update QP
-        contrast = db_c.loc[i, 'opacity']
-        response = db_c.loc[i, 'ifcorrect']
+        journal.write_trial(db_c, i, stage='main c',
+                            flips=timer.phase_times())
+        contrast = db_c[i, 'opacity']
+        response = db_c[i, 'ifcorrect']
         qp.update(contrast, response, approximate=True)
 
+        # if qp gives very different steps - change
+        if (i % 20 == 0) and (i <= 100):
+            contrasts, change = update_contrast_steps(qp, contrasts, corrs)
+
+            if change.any():
+                msg = 'Changed final contrast steps after trial {} to: {}\n'
+                lg.write(msg.format(i, contrasts))
+                apply_contrast_steps(db_c.column('step', start=i + 1),
+                                     db_c.column('opacity', start=i + 1),
+                                     contrasts, change)
+
+        # state is saved before the break, so that a session interrupted
+        # during the break resumes with current contrast steps
+        states.write(dict(stage='main c', trial=i, contrasts=contrasts))
+
         # break handling
         qp_refresh_rate = break_checker(
             stim['window'], exp, db_c, exp_info, lg, i,
             qp_refresh_rate=1000, plot_fun=plot_fun,
             plot_arg=[db_c, contrasts], dpi=120, img_name=img_name,
-            df_save_path=df_save_path, show_completed=True,
-            show_correctness=True, use_forced_break=True)
+            show_completed=True, show_correctness=True,
+            use_forced_break=True, writer=writer)
 
         # update experimenter
         exp_info.blok_info(u'główne badanie', [i, exp['numTrials']])
 
-        # if qp gives very different steps - change
-        if (i % 20 == 0) and (i <= 100):
-            new_contrasts = np.asarray(get_contrasts(qp, corrs))
-            weib = Weibull(kind='weibull')
-            weib.params = qp.get_fit_params()
-            old_corr = np.array([weib.predict(x) for x in contrasts])
-            new_corr = np.array([weib.predict(x) for x in new_contrasts])
-            perc_diff = np.abs(old_corr - new_corr) * 100
-            change = perc_diff > 3.5
-
-            if change.any():
-                msg = 'Changed final contrast steps after trial {} to: {}\n'
-                contrasts[change] = new_contrasts[change]
-                this_corr = old_corr.copy()
-
-                # additional check for corr % diff (between steps)
-                this_corr[change] = new_corr[change]
-                corr_dif = np.diff(this_corr) * 100
-
-                while (corr_dif < 3.).any():
-                    change_idx = np.where(corr_dif < 3.)
-                    for idx in change_idx:
-                        change[idx] = True
-                        change[idx + 1] = True
-                    contrasts[change] = new_contrasts[change]
-                    this_corr[change] = new_corr[change]
-                    corr_dif = np.diff(this_corr) * 100
-
-                lg.write(msg.format(i, contrasts))
-                step = db_c.loc[i + 1:, 'step'].values
-                opacity = db_c.loc[i + 1:, 'opacity'].values
-                for idx in range(len(contrasts)):
-                    if change[idx]:
-                        msk = step == idx + 1
-                        opacity[msk] = contrasts[idx]
-                db_c.loc[i + 1:, 'opacity'] = opacity
-
-    db_c.to_excel(dm.give_path('c'))
+    export_part(db_c.to_df(), 'c')
 
 # goodbye!
-corr = db_c.query('step > 2').ifcorrect.mean()
+corr = db_c.to_df().query('step > 2').ifcorrect.mean()
 payout = int(round(75. * corr))
 final_info(corr, payout, auto=exp['debug'], exp_info=exp_info)
+journal.close()
+states.close()
+writer.close()
+for error in writer.errors():
+    lg.write(error + '\n')
 core.quit()
@@ -0,0 +1,224 @@
+# contrast fitting procedure - stage logic shared by gabcon.py
+# and the headless simulator (simulate.py)
+from __future__ import absolute_import
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from weibull import Weibull, QuestPlus, weibull, from_db, block_candidates
+from trialdata import read_journal
+
+
+# correctness levels of the final contrast steps
+corrs = np.linspace(0.6, 0.9, num=5)
+
+# stages of the procedure (as logged in the trial journal), in order
+stages = ['training', 'staircase', 'Quest+', 'threshold fitting', 'main c']
+
+
+def create_staircase(max_trials):
+    '''Staircase used at the beginning of contrast fitting.'''
+    from psychopy.data import StairHandler
+    return StairHandler(0.8, nTrials=max_trials, nUp=1, nDown=2,
+                        nReversals=6, minVal=0.01, maxVal=2.,
+                        stepSizes=[0.1, 0.1, 0.05, 0.05, 0.025, 0.025],
+                        stepType='lin')
+
+
+def quest_plus_prior(model_params):
+    '''Prior for Quest+ model parameters (thresholds, slopes, lapses).'''
+    logfun = lambda x, th, slp: 0.8 / (1 + np.exp(-slp * (x - th))) + 0.2
+    x = np.linspace(0, 1, num=len(model_params[1]))
+    y1 = logfun(x, 0.1, 20)
+    y2 = logfun(x, 0.9, -20)
+    slope_prior = y1 * y2
+    lapse_prior = np.array([1., 1., 1., 1., 0.8, 0.5])
+    threshold_prior = np.ones(len(model_params[0]))
+
+    p1, p2, p3 = np.meshgrid(slope_prior, threshold_prior, lapse_prior)
+    priors = p1 * p2 * p3
+    priors /= priors.sum()
+    return priors.ravel()
+
+
+def create_quest_plus(exp, start_contrast, cache_dir=None):
+    '''Set up Quest+ with priors.
+
+    Returns
+    -------
+    qp : QuestPlus
+        QuestPlus object.
+    contrast : float
+        Contrast of the first Quest+ trial - stimulus domain value closest
+        to ``start_contrast``.
+    '''
+    stim_params = from_db(np.arange(-20, 3.1, 0.35)) # -20 dB is about 0.01
+    model_params = [exp['thresholds'], exp['slopes'], exp['lapses']]
+    qp = QuestPlus(stim_params, model_params, function=weibull,
+                   cache_dir=cache_dir, log_space=True)
+
+    # find starting contrast
+    min_idx = np.abs(stim_params - start_contrast).argmin()
+    contrast = stim_params[min_idx]
+
+    # set up priors
+    qp.posterior = quest_plus_prior(model_params)
+    return qp, contrast
+
+
+def get_contrasts(qp, corrs=corrs):
+    '''Contrasts corresponding to given correctness levels according to
+    current Quest+ parameters.'''
+    weib = Weibull(kind='weibull')
+    weib.params = qp.get_fit_params()
+    return weib.get_threshold(corrs)
+
+
+def plan_contrasts(qp, contrasts):
+    '''Contrasts for one block of threshold fitting trials (shuffled).'''
+    # each contrast step is used once, the other half of the block is
+    # chosen to minimize expected entropy of the posterior
+    contrasts = np.asarray(contrasts)
+    candidates = block_candidates(contrasts, len(contrasts))
+    # small chunks keep temporary arrays (and the planning time between
+    # blocks) small on the stimulus PC
+    planned = qp.plan_block(candidates, approximate=True, max_cells=2 ** 20)
+    use_contrasts = np.concatenate([contrasts, planned])
+    np.random.shuffle(use_contrasts)
+    return use_contrasts
+
+
+def update_contrast_steps(qp, contrasts, corrs=corrs):
+    '''Check if Quest+ gives very different contrast steps than those
+    currently used.
+
+    Returns
+    -------
+    contrasts : array
+        Contrast steps to use from now on.
+    change : boolean array
+        Which contrast steps were changed.
+    '''
+    contrasts = np.array(contrasts, dtype='float64')
+    new_contrasts = get_contrasts(qp, corrs)
+    weib = Weibull(kind='weibull')
+    weib.params = qp.get_fit_params()
+    old_corr = weib.predict(contrasts)
+    new_corr = weib.predict(new_contrasts)
+    perc_diff = np.abs(old_corr - new_corr) * 100
+    change = perc_diff > 3.5
+
+    if change.any():
+        contrasts[change] = new_contrasts[change]
+        this_corr = old_corr.copy()
+
+        # additional check for corr % diff (between steps)
+        this_corr[change] = new_corr[change]
+        corr_dif = np.diff(this_corr) * 100
+
+        while (corr_dif < 3.).any():
+            change_idx = np.where(corr_dif < 3.)
+            for idx in change_idx:
+                change[idx] = True
+                change[idx + 1] = True
+            contrasts[change] = new_contrasts[change]
+            this_corr[change] = new_corr[change]
+            corr_dif = np.diff(this_corr) * 100
+    return contrasts, change
+
+
+def apply_contrast_steps(step, opacity, contrasts, change):
+    '''Set opacity of trials with changed contrast steps (in place).
+
+    step - step number (starting with 1) of each remaining trial
+    opacity - opacity of each remaining trial
+    '''
+    for idx in range(len(contrasts)):
+        if change[idx]:
+            msk = step == idx + 1
+            opacity[msk] = contrasts[idx]
+    return opacity
+
+
+def load_session(journal_path, state_path):
+    '''Read trial journal and state records of an interrupted session.
+
+    Returns
+    -------
+    session : dict | None
+        ``'trials'`` - logged trials (DataFrame), ``'stage'`` - index of
+        the last stage in ``stages``, ``'states'`` - state records
+        (DataFrame). ``None`` if there is no journal or it is empty.
+    '''
+    if not journal_path or not os.path.isfile(journal_path):
+        return None
+    trials = read_journal(journal_path)
+    if trials.shape[0] == 0:
+        return None
+    states = (read_journal(state_path) if state_path and
+              os.path.isfile(state_path) else None)
+    return dict(trials=trials, stage=stages.index(trials.stage.iloc[-1]),
+                states=states)
+
+
+def session_trials(session, stage_names):
+    '''Logged trials of given stages (empty DataFrame if there is no
+    session).'''
+    if session is None:
+        return pd.DataFrame(columns=['trial', 'stage', 'opacity',
+                                     'ifcorrect'])
+    trials = session['trials']
+    return trials[trials.stage.isin(stage_names)].reset_index(drop=True)
+
+
+def replay_staircase(staircase, responses):
+    '''Bring staircase to the state after given responses.'''
+    for response, contrast in zip(responses, staircase):
+        staircase.addResponse(response)
+    return staircase
+
+
+def main_c_plan(db_c):
+    '''State record with the order of part c trials.'''
+    plan = {col: db_c.column(col).tolist()
+            for col in ['fixTime', 'orientation', 'step', 'opacity']}
+    return dict(stage='main c plan', trial=0, **plan)
+
+
+def restore_main_c(db_c, session):
+    '''Restore order of part c trials, presented trials and current contrast
+    steps of an interrupted session.
+
+    Returns
+    -------
+    contrasts : array | None
+        Contrast steps used at the end of the session (``None`` if part c
+        has not started).
+    next_trial : int
+        Part c trial to continue from.
+    '''
+    states = None if session is None else session['states']
+    if states is None or not (states.stage == 'main c plan').any():
+        return None, 1
+
+    plan = states[states.stage == 'main c plan'].iloc[-1]
+    for col in ['fixTime', 'orientation', 'step', 'opacity']:
+        db_c.column(col)[:] = plan[col]
+
+    trials = session_trials(session, ['main c'])
+    db_c.fill(trials)
+    next_trial = trials.trial.max() + 1 if trials.shape[0] > 0 else 1
+
+    # contrast steps changed after the last presented trial
+    contrasts = np.array(plan['opacity'])[
+        np.unique(plan['step'], return_index=True)[1]]
+    steps = states[states.stage == 'main c']
+    if steps.shape[0] > 0:
+        contrasts = np.asarray(steps.contrasts.iloc[-1])
+        change = np.ones(len(contrasts), dtype='bool')
+        apply_contrast_steps(db_c.column('step', start=next_trial),
+                             db_c.column('opacity', start=next_trial),
+                             contrasts, change)
+    return contrasts, next_trial
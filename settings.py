@@ -34,6 +34,9 @@ exp['max opac']    = 2.0          # NOT USED? (but could be)
 exp['thresholds'] = np.logspace(np.log10(0.01), np.log10(1.5), num=50)
 exp['slopes'] = np.logspace(np.log10(0.15), np.log10(20.), num=50)
 exp['lapses'] = np.arange(0., 0.06, 0.01)
+# model parameter whose entropy QUEST+ minimizes: None - all parameters,
+# 0 - threshold only
+exp['QUEST plus axis'] = None
 
 # training settings
 exp['train slow']   = [8, 5, 3, 2, 1]
@@ -45,6 +48,11 @@ exp['staircase trials']  = 25   # max value, default 25
 exp['QUEST plus trials'] = 100   # default 100
 exp['thresh opt trials'] = 50    # default 60 = 15 * 4
 
+# trial journal: force trials to disk every N trials (0 - leave it to the OS)
+exp['journal fsync every'] = 1
+# format of session files added to the lab dataset: 'parquet' or 'feather'
+exp['export format'] = 'parquet'
+
 # subject info
 # ------------
 sub_data = getSubject()
@@ -56,6 +64,8 @@ exp['participant']['ID'] = sub_data[0]
 exp['participant']['sex'] = sub_data[1][0]
 exp['participant distance'] = sub_data[2]
 exp['debug'] = sub_data[3] == 'True'
+# continue interrupted session from its trial journal
+exp['resume'] = sub_data[4] == 'True'
 
 
 # timing settings
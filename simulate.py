@@ -0,0 +1,229 @@
+# headless simulation of the contrast fitting procedure and the main
+# experiment (part c) - no windows are opened and no real time passes
+from __future__ import absolute_import
+
+import random
+
+import numpy as np
+
+from trialdata import create_database, TrialRecorder
+from weibull import Weibull, PsychometricMonkey
+from utils import trim_df
+from procedure import (corrs, create_staircase, create_quest_plus,
+                       get_contrasts, plan_contrasts, update_contrast_steps,
+                       apply_contrast_steps)
+
+
+def simulation_exp(**kwargs):
+    '''Experiment settings used in simulations. Mirrors settings.py (without
+    the subject dialog and frame rate check). Any setting can be overridden
+    with keyword arguments, for example:
+    exp = simulation_exp(**{'QUEST plus trials': 60})
+    '''
+    exp = dict()
+    exp['debug'] = True
+
+    # parameter settings for QUEST+
+    exp['thresholds'] = np.logspace(np.log10(0.01), np.log10(1.5), num=50)
+    exp['slopes'] = np.logspace(np.log10(0.15), np.log10(20.), num=50)
+    exp['lapses'] = np.arange(0., 0.06, 0.01)
+    exp['QUEST plus axis'] = None
+
+    # fitting settings
+    exp['break after']  = 12
+    exp['staircase trials']  = 25
+    exp['QUEST plus trials'] = 100
+    exp['thresh opt trials'] = 50
+    exp['main c reps'] = 32
+    exp['journal fsync every'] = 1
+
+    # timing settings
+    exp['targetTime']  = [1]
+    exp['SMI']         = [2]
+    exp['fixTimeLim']  = [1., 2.5]
+    exp['maskTime']    = [20]
+    exp['respWait']    = 1.5
+    exp['frm'] = dict(rate=60., time=1000. / 60.)
+
+    # stimuli and responses
+    exp['orientation'] = [0, 45, 90, 135]
+    exp['use keys']    = ['f', 'j']
+    exp['keymap'] = {0: 'f', 90: 'f', 45: 'j', 135: 'j'}
+
+    exp.update(kwargs)
+    return exp
+
+
+class VirtualClock(object):
+    '''Clock that is advanced by simulated durations instead of real
+    time.'''
+    def __init__(self, frame_time):
+        self.time = 0.
+        self.frame_time = frame_time / 1000.
+
+    def wait(self, seconds):
+        self.time += seconds
+
+    def wait_frames(self, frames):
+        self.time += frames * self.frame_time
+
+    def getTime(self):
+        return self.time
+
+
+class SimulatedTrials(object):
+    '''Presents trials from a trial database to a simulated observer -
+    headless counterpart of stimutils.present_trial.
+
+    Trial data are kept in a TrialRecorder (``self.data``) and turned into
+    a DataFrame with ``to_df``.
+    '''
+    def __init__(self, db, exp, observer, clock, trial_type=False):
+        self.exp = exp
+        self.observer = observer
+        self.clock = clock
+        extra_columns = {'trial_type': 'object'} if trial_type else None
+        self.data = TrialRecorder(db, extra_columns=extra_columns)
+
+    def present(self, trial, contrast=None, trial_type=None):
+        '''Present trial and return whether the response was correct.'''
+        data = self.data
+        if contrast is not None:
+            data[trial, 'opacity'] = contrast
+        if trial_type is not None:
+            data[trial, 'trial_type'] = trial_type
+
+        # pre-fixation interval, then fixation, target, SMI and mask
+        self.clock.wait(0.5)
+        data[trial, 'time'] = self.clock.getTime()
+        self.clock.wait_frames(data[trial, 'fixTime'] +
+                               data[trial, 'targetTime'] +
+                               data[trial, 'SMI'] + data[trial, 'maskTime'])
+
+        # response
+        orientation = data[trial, 'orientation']
+        key = self.observer.respond(data.row(trial))
+        rt = 0.1 + np.random.rand() * 0.2
+        ifcorrect = int(self.exp['keymap'][orientation] == key)
+        data[trial, 'response'] = key
+        data[trial, 'RT'] = rt
+        data[trial, 'ifcorrect'] = ifcorrect
+
+        # after 250 - 500 ms from response mask disappears
+        self.clock.wait(rt + np.random.randint(25, 50) / 100. + 0.02)
+        return ifcorrect
+
+    def to_df(self):
+        return self.data.to_df()
+
+
+def simulate_session(exp=None, observer_params=(0.2, 6.5, 0.03), seed=None,
+                     cache_dir=None, run_main_c=True):
+    '''Simulate the contrast fitting procedure (staircase, Quest+, threshold
+    fitting) and part c of the experiment for one simulated observer.
+
+    Parameters
+    ----------
+    exp : dict | None
+        Experiment settings, see ``simulation_exp``.
+    observer_params : sequence of float
+        Weibull parameters (threshold, slope, lapse) of the observer.
+    seed : int | None
+        Seed for numpy and python random generators (the procedure uses
+        the global generators, just like gabcon.py).
+    cache_dir : str | None
+        Directory for caching Quest+ likelihood table.
+    run_main_c : bool
+        Whether to simulate part c.
+
+    Returns
+    -------
+    results : dict
+        ``'fitting'`` - DataFrame of fitting trials (like ``ID_b_N.xls``),
+        ``'main'`` - DataFrame of part c trials (like ``ID_c_N.xls``,
+        ``None`` if part c is not simulated), ``'qp'`` - final QuestPlus,
+        ``'contrasts'`` - final contrast steps, ``'duration'`` - simulated
+        session duration in seconds (without breaks).
+    '''
+    if seed is not None:
+        np.random.seed(seed)
+        random.seed(seed)
+    exp = simulation_exp() if exp is None else exp
+
+    psychometric = Weibull(kind='weibull')
+    psychometric.params = list(observer_params)
+    observer = PsychometricMonkey(
+        psychometric=psychometric, response_mapping=exp['keymap'],
+        intensity_var='opacity', stimulus_var='orientation')
+    clock = VirtualClock(exp['frm']['time'])
+
+    max_fitting = (35 + exp['QUEST plus trials'] + exp['thresh opt trials'] +
+                   2 * len(corrs))
+    fitting_db = create_database(exp, trials=max(600, max_fitting))
+    fitting = SimulatedTrials(fitting_db, exp, observer, clock,
+                              trial_type=True)
+
+    # staircase
+    current_trial = 1
+    staircase = create_staircase(exp['staircase trials'])
+    for contrast in staircase:
+        # never go longer than 35 trials
+        if current_trial > 35:
+            break
+        response = fitting.present(current_trial, contrast=contrast,
+                                   trial_type='staircase')
+        staircase.addResponse(response)
+        current_trial += 1
+
+    # Quest+
+    qp, contrast = create_quest_plus(exp, staircase._nextIntensity,
+                                     cache_dir=cache_dir)
+    for trial in range(exp['QUEST plus trials']):
+        response = fitting.present(current_trial, contrast=contrast,
+                                   trial_type='Quest+')
+        qp.update(contrast, response)
+        contrast = qp.next_contrast(axis=exp['QUEST plus axis'])
+        current_trial += 1
+
+    # threshold fitting
+    contrasts = get_contrasts(qp, corrs)
+    use_contrasts = plan_contrasts(qp, contrasts)
+    trial = 0
+    while trial + 1 <= exp['thresh opt trials']:
+        for contrast in use_contrasts:
+            response = fitting.present(current_trial, contrast=contrast,
+                                       trial_type='Quest+')
+            qp.update(contrast, response, approximate=True)
+            current_trial += 1
+            trial += 1
+        contrasts = get_contrasts(qp, corrs)
+        use_contrasts = plan_contrasts(qp, contrasts)
+
+    results = dict(fitting=trim_df(fitting.to_df()), main=None, qp=qp,
+                   contrasts=np.asarray(contrasts))
+
+    # part c
+    if run_main_c:
+        contrasts = get_contrasts(qp, corrs)
+        db_c = create_database(exp, combine_with=('opacity', contrasts),
+                               rep=exp['main c reps'], shuffle_in_reps=True,
+                               numerate_steps=True)
+        main = SimulatedTrials(db_c, exp, observer, clock)
+        contrasts = np.asarray(contrasts)
+        for i in range(1, db_c.shape[0] + 1):
+            response = main.present(i)
+            qp.update(main.data[i, 'opacity'], response, approximate=True)
+
+            # if qp gives very different steps - change
+            if (i % 20 == 0) and (i <= 100):
+                contrasts, change = update_contrast_steps(qp, contrasts, corrs)
+                if change.any():
+                    apply_contrast_steps(
+                        main.data.column('step', start=i + 1),
+                        main.data.column('opacity', start=i + 1),
+                        contrasts, change)
+        results['main'] = main.to_df()
+        results['contrasts'] = contrasts
+
+    results['duration'] = clock.getTime()
+    return results
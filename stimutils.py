@@ -7,15 +7,17 @@ import re
 import yaml
 import time
 from random import sample
+from functools import partial
 import numpy  as np
 import matplotlib.pyplot as plt
 
-from psychopy import core, visual, event, monitors
+from psychopy import core, visual, event, monitors, logging
 from psychopy.monitors import Monitor
 
 from settings import exp, db
-from exputils import getFrameRate, trim_df
+from exputils import getFrameRate, TrialRecorder, frame_columns
 from utils    import trim, to_percent
+from viz      import figure_to_image
 
 if os.name == 'nt' and exp['use trigger']:
 	from ctypes import windll
@@ -192,24 +194,34 @@ def clear_port(portdict):
 # PRESENTATION
 # ------------
 
-def present_trial(trial, exp=exp, stim=stim, db=db, win=stim['window'],
-				  contrast=1., monkey=None):
+def present_trial(trial, exp=exp, stim=stim, db=None, win=stim['window'],
+				  contrast=1., monkey=None, timer=None):
+	'''Present trial. Trial data are read from and written to ``db``
+	(TrialRecorder). If ``timer`` (FrameTimer) is given, flips are timed and
+	frame timing is written to ``db`` (that needs ``frame_columns``).'''
 	# PREPARE
 	# -------
 	# randomize opacity if not set
 	if contrast is not None:
-		db.loc[trial, 'opacity'] = contrast
+		db[trial, 'opacity'] = contrast
 	else:
-		contrast = db.loc[trial, 'opacity']
+		contrast = db[trial, 'opacity']
 
 	# set target properties
-	orientation = db.loc[trial, 'orientation']
+	orientation = db[trial, 'orientation']
 	target = stim['target'][orientation]
 	target.set_contrast(contrast)
-	target_code = 'target_' + str(int(db.loc[trial, 'orientation']))
+	target_code = 'target_' + str(int(orientation))
 
 	# get trial start time
-	db.loc[trial, 'time'] = core.getTime()
+	db[trial, 'time'] = core.getTime()
+
+	# timed or plain flips
+	if timer is None:
+		flip, phase = win.flip, _no_phase
+	else:
+		timer.reset()
+		flip, phase = partial(timer.flip, win), timer.phase
 
 
 	# PRESENT
@@ -217,9 +229,10 @@ def present_trial(trial, exp=exp, stim=stim, db=db, win=stim['window'],
 
 	# present fix:
 	win.callOnFlip(onflip_work, exp['port'], code='fix')
-	for f in np.arange(db.loc[trial, 'fixTime']):
+	phase('fix')
+	for f in np.arange(db[trial, 'fixTime']):
 		stim['fix'].draw()
-		win.flip()
+		flip()
 		if f == 3:
 			clear_port(exp['port'])
 
@@ -231,20 +244,23 @@ def present_trial(trial, exp=exp, stim=stim, db=db, win=stim['window'],
 	# present target
 	win.callOnFlip(onflip_work, exp['port'], code=target_code,
 				   clock=exp['clock'])
-	for f in np.arange(db.loc[trial, 'targetTime']):
+	phase('target')
+	for f in np.arange(db[trial, 'targetTime']):
 		target.draw()
-		win.flip()
+		flip()
 
 	# interval
-	for f in np.arange(db.loc[trial, 'SMI']):
-		win.flip()
+	phase('SMI')
+	for f in np.arange(db[trial, 'SMI']):
+		flip()
 	clear_port(exp['port'])
 
 	# mask
-	for f in np.arange(db.loc[trial, 'maskTime']):
+	phase('mask')
+	for f in np.arange(db[trial, 'maskTime']):
 		for m in stim['mask']:
 			m.draw()
-		win.flip()
+		flip()
 
 	# response
 	evaluate_response(db, exp, trial, monkey=monkey)
@@ -256,10 +272,24 @@ def present_trial(trial, exp=exp, stim=stim, db=db, win=stim['window'],
 
 	# send mask offset trigger
 	win.callOnFlip(onflip_work, exp['port'], code='mask_offset')
-	win.flip()
+	phase('offset')
+	flip()
 	core.wait(0.02)
 	clear_port(exp['port'])
 
+	if timer is not None:
+		timer.record(db, trial)
+		if db[trial, 'timingError']:
+			logging.warning('trial {}: target lasted {:.1f} ms ({} frames '
+				'planned), SMI lasted {:.1f} ms ({} frames planned), {} '
+				'dropped frames'.format(trial, db[trial, 'targetDur'],
+				db[trial, 'targetTime'], db[trial, 'SMIDur'], db[trial, 'SMI'],
+				db[trial, 'droppedFrames']))
+
+
+def _no_phase(name):
+	pass
+
 
 def evaluate_response(df, exp, trial, monkey=None):
 	# which keys we wait for:
@@ -275,7 +305,7 @@ def evaluate_response(df, exp, trial, monkey=None):
 									 timeStamped=exp['clock'])
 	else:
 		core.wait(0.1 + np.random.rand() * 0.2)
-		k = [(monkey.respond(df.loc[trial, :]), 0.15)]
+		k = [(monkey.respond(df.row(trial)), 0.15)]
 
 	# calculate RT and ifcorrect
 	if k:
@@ -291,20 +321,22 @@ def evaluate_response(df, exp, trial, monkey=None):
 				core.quit()
 
 		# performance
-		df.loc[trial, 'response']  = key
-		df.loc[trial, 'RT']        = RT
-		target_ori = df.loc[trial]['orientation']
-		df.loc[trial, 'ifcorrect'] = int(exp['keymap'][target_ori] == key)
+		df[trial, 'response']  = key
+		df[trial, 'RT']        = RT
+		target_ori = df[trial, 'orientation']
+		df[trial, 'ifcorrect'] = int(exp['keymap'][target_ori] == key)
 	else:
-		df.loc[trial, 'response']  = 'NoResp'
-		df.loc[trial, 'ifcorrect'] = 0
+		df[trial, 'response']  = 'NoResp'
+		df[trial, 'ifcorrect'] = 0
 
 
 # - [ ] TODO Monkey istead of auto
 def present_training(trial, db, exp=exp, slowdown=5, mintrials=10, corr=0.8,
 					 stim=stim, monkey=None, contrast=1., exp_info=None,
-					 block_num=None):
-	'''Present a block of training data.'''
+					 block_num=None, journal=None, timer=None):
+	'''Present a block of training data. Trials are appended to
+	``journal`` (TrialJournal) if given, flips are timed with ``timer``
+	(FrameTimer) if given.'''
 
 	train_corr = 0
 	auto = monkey is not None
@@ -312,10 +344,12 @@ def present_training(trial, db, exp=exp, slowdown=5, mintrials=10, corr=0.8,
 	txt = u'Twoja poprawność:\n{}\n\ndocelowa poprawność:\n{}'
 	txt += u'\n\n Aby przejść dalej naciśnij spację.'
 
-	train_db = give_training_db(db, slowdown=slowdown)
+	train_db = TrialRecorder(give_training_db(db, slowdown=slowdown),
+							 extra_columns=(frame_columns if timer is not None
+											else None))
 	exp['opacity'] = np.array([1., 1.])
-	exp['targetTime'] = [train_db.loc[trial, 'targetTime']]
-	exp['SMI'] = [train_db.loc[trial, 'SMI']]
+	exp['targetTime'] = [train_db[trial, 'targetTime']]
+	exp['SMI'] = [train_db[trial, 'SMI']]
 
 	if exp_info is not None:
 		start_trial = trial - 1
@@ -325,13 +359,19 @@ def present_training(trial, db, exp=exp, slowdown=5, mintrials=10, corr=0.8,
 	while train_corr < corr or trial < mintrials:
 		stim['window'].flip()
 		core.wait(0.5)
-		present_trial(trial, exp=exp, db=db, contrast=contrast,
-					  monkey=monkey)
-		present_feedback(trial, db=db)
+		present_trial(trial, exp=exp, db=train_db, contrast=contrast,
+					  monkey=monkey, timer=timer)
+		present_feedback(trial, db=train_db)
+		if journal is not None:
+			block = None if block_num is None else block_num[0]
+			flips = None if timer is None else timer.phase_times()
+			journal.write_trial(train_db, trial, stage='training',
+								block=block, flips=flips)
 
 		# check correctness
 		start_last = max(1, trial - mintrials + 1)
-		train_corr = db.loc[start_last:trial, 'ifcorrect'].mean()
+		train_corr = train_db.column('ifcorrect', start=start_last)[
+			:trial - start_last + 1].mean()
 
 		if exp_info is not None:
 			this_info_msg = info_msg.format(block_num[0], block_num[1],
@@ -349,11 +389,11 @@ def present_training(trial, db, exp=exp, slowdown=5, mintrials=10, corr=0.8,
 				contrast += 0.5
 		trial += 1
 	# return db so it can be saved
-	return train_db, train_corr, contrast
+	return train_db.to_df(), train_corr, contrast
 
 
-def present_feedback(i, db=db, stim=stim):
-	if db.loc[i, 'ifcorrect'] == 1:
+def present_feedback(i, db=None, stim=stim):
+	if db[i, 'ifcorrect'] == 1:
 		stim['feedback'].setFillColor([0.1, 0.9, 0.1])
 		stim['feedback'].setLineColor([0.1, 0.9, 0.1])
 	else:
@@ -512,16 +552,14 @@ def final_info(corr, payout, win=stim['window'], auto=False, exp_info=None):
 
 def break_checker(window, exp, df, exp_info, logfile, current_trial,
                   qp_refresh_rate=3, plot_fun=None, plot_arg=None, dpi=120,
-                  img_name='temp.png', df_save_path='temp.xlsx',
-                  show_completed=False, show_correctness=False,
-                  use_forced_break=False):
+                  img_name='temp.png', show_completed=False,
+                  show_correctness=False, use_forced_break=False,
+                  writer=None):
+    # trials are saved in the trial journal, so only the plot is written
+    # here - in the background if writer (BackgroundWriter) is given
 
     has_break = current_trial % exp['break after'] == 0
     has_forced_break = current_trial == 214 or current_trial == 428
-    if has_break:
-        save_df = trim_df(df)
-        save_df.to_excel(df_save_path)
-
     if use_forced_break and has_forced_break:
         forced_break(win=window, auto=exp['debug'], exp_info=exp_info)
 
@@ -532,8 +570,8 @@ def break_checker(window, exp, df, exp_info, logfile, current_trial,
 
     if show_completed and (has_break or (has_forced_break and use_forced_break)):
         if show_correctness:
-            upper_steps = df.query('step > 2')
-            avg_corr = upper_steps.ifcorrect.mean() * 100
+            upper_steps = df.column('step') > 2
+            avg_corr = df.column('ifcorrect')[upper_steps].mean() * 100
             present_break(current_trial, exp=exp, win=window, auto=exp['debug'],
                           correctness=avg_corr)
         else:
@@ -544,12 +582,22 @@ def break_checker(window, exp, df, exp_info, logfile, current_trial,
         # make sure feedback is only shown after the break on one screen
         qp_refresh_rate = 10000
 
+    # report errors of background exports
+    if writer is not None and has_break:
+        for error in writer.errors():
+            logfile.write(error + '\n')
+
     # visual feedback on parameters probability
     if current_trial % qp_refresh_rate == 0 or has_break:
+        image = img_name
         try:
             fig = plot_fun(plot_arg)
-            fig.savefig(img_name, dpi=dpi)
+            image = figure_to_image(fig, dpi=dpi)
             plt.close(fig)
+            if writer is not None:
+                writer.save_image(image, img_name)
+            else:
+                image.save(img_name)
             window.winHandle.activate()
         except:
             pass
@@ -557,7 +605,7 @@ def break_checker(window, exp, df, exp_info, logfile, current_trial,
         if not exp['two screens']:
             win.blendMode = 'avg'
 
-        exp_info.experimenter_plot(img_name)
+        exp_info.experimenter_plot(image)
 
         if not exp['two screens']:
             event.waitKeys(['f', 'j', 'space', 'return'])
@@ -0,0 +1,203 @@
+# parameter sweeps of headless procedure simulations (see simulate.py)
+# run in a process pool
+#
+# example:
+# --------
+# if __name__ == '__main__':
+#     tasks = sweep_tasks([[0.2, 6.5, 0.03], [0.1, 3., 0.01]],
+#                         [{'QUEST plus trials': 60},
+#                          {'QUEST plus trials': 100}], n_repetitions=50)
+#     run_sweep(tasks, 'sweep_results', n_jobs=8)
+#     df = read_sweep('sweep_results')
+from __future__ import absolute_import
+
+import os
+import re
+from itertools import product
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from procedure import corrs, create_quest_plus
+
+
+def sweep_tasks(observer_params, settings=None, n_repetitions=1):
+    '''Create simulation tasks for all combinations of observer parameters
+    and experiment settings.
+
+    Parameters
+    ----------
+    observer_params : list of sequences
+        Weibull parameters (threshold, slope, lapse) of simulated observers.
+    settings : list of dict | None
+        Experiment settings to override in ``simulation_exp`` for example
+        ``[{'QUEST plus trials': 60}, {'QUEST plus trials': 100}]``.
+    n_repetitions : int
+        Number of simulations for each combination.
+
+    Returns
+    -------
+    tasks : list of dict
+        Simulation tasks with consecutive ``task_id``.
+    '''
+    if settings is None:
+        settings = [dict()]
+    tasks = list()
+    combinations = product(range(len(observer_params)), range(len(settings)),
+                           range(n_repetitions))
+    for task_id, (obs_idx, set_idx, rep) in enumerate(combinations):
+        tasks.append(dict(task_id=task_id, observer=obs_idx, settings=set_idx,
+                          repetition=rep,
+                          observer_params=list(observer_params[obs_idx]),
+                          exp=settings[set_idx]))
+    return tasks
+
+
+def task_seed(base_seed, task_id):
+    '''Deterministic seed of a simulation task.'''
+    return int((base_seed * 1000003 + task_id) % (2 ** 32))
+
+
+def summarize_session(results):
+    '''Summarize simulated session as one row of results.'''
+    qp = results['qp']
+    threshold, slope, lapse = qp.get_fit_params()
+    row = dict(est_threshold=threshold, est_slope=slope, est_lapse=lapse,
+               duration=results['duration'],
+               n_fitting_trials=results['fitting'].shape[0])
+    for idx, contrast in enumerate(results['contrasts'], start=1):
+        row['contrast_{}'.format(idx)] = contrast
+    if results['main'] is not None:
+        main = results['main']
+        step_corr = main.ifcorrect.astype('float64').groupby(main.step).mean()
+        for step in range(1, len(corrs) + 1):
+            row['corr_step_{}'.format(step)] = step_corr.get(step, np.nan)
+    return row
+
+
+def _run_task(args):
+    from simulate import simulate_session, simulation_exp
+
+    task, base_seed, cache_dir, run_main_c = args
+    seed = task_seed(base_seed, task['task_id'])
+    results = simulate_session(
+        exp=simulation_exp(**task['exp']),
+        observer_params=task['observer_params'], seed=seed,
+        cache_dir=cache_dir, run_main_c=run_main_c)
+
+    row = dict(task_id=task['task_id'], observer=task['observer'],
+               settings=task['settings'], repetition=task['repetition'],
+               seed=seed)
+    for name, val in zip(['threshold', 'slope', 'lapse'],
+                         task['observer_params']):
+        row['observer_' + name] = val
+    for key, val in task['exp'].items():
+        row[key] = (val if val is None or np.isscalar(val)
+                    else str(list(val)))
+    row.update(summarize_session(results))
+    return row
+
+
+def _part_files(output_dir):
+    return sorted(fl for fl in os.listdir(output_dir)
+                  if re.match(r'part_[0-9]+\.parquet$', fl))
+
+
+def finished_tasks(output_dir):
+    '''Ids of tasks already saved in output_dir.'''
+    if not os.path.isdir(output_dir):
+        return set()
+    done = set()
+    for fl in _part_files(output_dir):
+        df = pd.read_parquet(os.path.join(output_dir, fl),
+                             columns=['task_id'])
+        done.update(df.task_id.tolist())
+    return done
+
+
+def _write_part(output_dir, rows):
+    part_idx = len(_part_files(output_dir))
+    fname = os.path.join(output_dir, 'part_{:05d}.parquet'.format(part_idx))
+    tmp_fname = fname + '.tmp'
+    pd.DataFrame(rows).to_parquet(tmp_fname, index=False)
+    os.rename(tmp_fname, fname)
+
+
+def run_sweep(tasks, output_dir, n_jobs=None, base_seed=0, cache_dir=None,
+              run_main_c=True, write_every=50):
+    '''Run simulation tasks in a process pool.
+
+    Results are streamed to ``output_dir`` as consecutive Parquet part files
+    (one per ``write_every`` finished tasks). Tasks already present in
+    ``output_dir`` are skipped, so an interrupted sweep can be resumed by
+    calling ``run_sweep`` again with the same tasks. Each task gets a seed
+    depending only on ``base_seed`` and its ``task_id`` so results do not
+    depend on the number of processes or the order of execution.
+
+    On Windows ``run_sweep`` has to be called from within
+    ``if __name__ == '__main__':`` block.
+
+    Parameters
+    ----------
+    tasks : list of dict
+        Tasks created with ``sweep_tasks``.
+    output_dir : str
+        Directory for results.
+    n_jobs : int | None
+        Number of processes. Defaults to ``None`` - all cores.
+    base_seed : int
+        Base random seed of the sweep.
+    cache_dir : str | None
+        Directory for caching Quest+ likelihood tables - processes then
+        share one memory-mapped table. Defaults to ``output_dir``.
+    run_main_c : bool
+        Whether to simulate part c.
+    write_every : int
+        Number of finished tasks saved in one part file.
+
+    Returns
+    -------
+    n_run : int
+        Number of tasks run (not counting the tasks finished earlier).
+    '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    cache_dir = output_dir if cache_dir is None else cache_dir
+    done = finished_tasks(output_dir)
+    todo = [(task, base_seed, cache_dir, run_main_c) for task in tasks
+            if task['task_id'] not in done]
+    if not todo:
+        return 0
+
+    # cache likelihood and outcome entropy tables before the workers start
+    # so that they are computed only once and not by every process
+    from simulate import simulation_exp
+    for exp_settings in {repr(sorted(task['exp'].items())): task['exp']
+                         for task, _, _, _ in todo}.values():
+        qp, _ = create_quest_plus(simulation_exp(**exp_settings), 0.5,
+                                  cache_dir=cache_dir)
+        qp._cell_entropy
+
+    rows = list()
+    pool = Pool(processes=n_jobs)
+    try:
+        for row in pool.imap_unordered(_run_task, todo):
+            rows.append(row)
+            if len(rows) >= write_every:
+                _write_part(output_dir, rows)
+                rows = list()
+    finally:
+        if rows:
+            _write_part(output_dir, rows)
+        pool.terminate()
+        pool.join()
+    return len(todo)
+
+
+def read_sweep(output_dir):
+    '''Read all sweep results as one DataFrame sorted by task id.'''
+    parts = [pd.read_parquet(os.path.join(output_dir, fl))
+             for fl in _part_files(output_dir)]
+    df = pd.concat(parts, ignore_index=True)
+    return df.sort_values('task_id').reset_index(drop=True)
@@ -0,0 +1,47 @@
+from __future__ import print_function
+import os
+import time
+import tempfile
+from exputils import DataManager, FileLock
+
+data_dir = tempfile.mkdtemp()
+exp = dict(keymap={0: 'f', 45: 'j', 90: 'f', 135: 'j'}, choose_resp=0,
+           participant=dict(ID='S01', sex='k'), data=data_dir)
+
+
+def allocate(idx):
+    return DataManager(exp).give_path('b')
+
+
+if __name__ == '__main__':
+    # session 1 writes its journal
+    dm = DataManager(exp)
+    first_journal = dm.give_path('j', file_ending='jsonl')
+    with open(first_journal, 'w') as f:
+        f.write('{"trial": 1, "stage": "training"}\n')
+
+    # each resume allocates a new journal path that is never written (the
+    # journal of session 1 is continued) - still session 1 has to be found
+    for resume in range(3):
+        dm = DataManager(exp)
+        previous = dm.give_previous_path('j', file_ending='jsonl')
+        print('resume {}: '.format(resume + 1), os.path.basename(previous))
+        assert previous == first_journal
+        assert dm.give_path('j', file_ending='jsonl') != first_journal
+    assert DataManager(exp).give_previous_path('c') == ''
+
+    # processes allocating at the same time get different paths
+    from multiprocessing import Pool
+    pool = Pool(8)
+    paths = pool.map(allocate, range(160))
+    pool.close()
+    pool.join()
+    assert len(set(paths)) == 160
+
+    # lock left by a crashed process is removed once it is stale
+    lock_path = os.path.join(data_dir, 'crashed.lock')
+    open(lock_path, 'w').close()
+    start = time.time()
+    with FileLock(lock_path, timeout=2., stale=0.5):
+        pass
+    assert 0.3 < time.time() - start < 2.
@@ -0,0 +1,35 @@
+from __future__ import print_function
+import tempfile
+from simulate import simulate_session
+from dataset import export_session, load_dataset, read_index, rebuild_index
+
+# export simulated sessions of two subjects and load them back
+results = simulate_session(seed=0)
+data_dir = tempfile.mkdtemp()
+for subject in ['S01', 'S02']:
+    export_session(results['fitting'], data_dir, subject, 1, 'b')
+    export_session(results['main'], data_dir, subject, 1, 'c')
+print(read_index(data_dir))
+assert read_index(data_dir).shape[0] == 4
+
+df = load_dataset(data_dir, parts=['c'])
+print(df.groupby(['subject', 'step']).ifcorrect.mean())
+assert df.shape[0] == 2 * results['main'].shape[0]
+assert (df.step > 0).all()
+assert rebuild_index(data_dir).shape[0] == 4
+
+
+# stations exporting at the same time should not lose index entries
+def export_subject(subject):
+    export_session(results['fitting'].iloc[:10], data_dir, subject, 1, 'b')
+
+
+if __name__ == '__main__':
+    from multiprocessing import Pool
+    pool = Pool(8)
+    pool.map(export_subject, ['P{:02d}'.format(idx) for idx in range(32)])
+    pool.close()
+    pool.join()
+    print('index entries after concurrent exports: ',
+        read_index(data_dir).shape[0])
+    assert read_index(data_dir).shape[0] == 4 + 32
@@ -0,0 +1,65 @@
+from __future__ import print_function
+import numpy as np
+from exputils import (create_database, TrialRecorder, FrameTimer,
+                      frame_columns)
+
+# construct exp
+exp = dict()
+exp['targetTime']  = [1]
+exp['SMI']         = [2]
+exp['fixTimeLim']  = [0.75, 2.5]
+exp['maskTime']    = [20]
+exp['orientation'] = [0, 45, 90, 135]
+exp['frm'] = dict()
+exp['frm']['time'] = 10
+
+
+class FakeWindow(object):
+    '''Window that flips every 10 ms, frames listed in ``drop`` take
+    twice as long.'''
+    def __init__(self, drop=()):
+        self.time = 0.
+        self.frame = 0
+        self.drop = drop
+
+    def flip(self):
+        self.time += 0.02 if self.frame in self.drop else 0.01
+        self.frame += 1
+        return self.time
+
+
+def run_trial(rec, trial, timer, win):
+    timer.reset()
+    for name, frames in [('fix', rec[trial, 'fixTime']),
+                         ('target', rec[trial, 'targetTime']),
+                         ('SMI', rec[trial, 'SMI']),
+                         ('mask', rec[trial, 'maskTime']), ('offset', 1)]:
+        timer.phase(name)
+        for f in range(frames):
+            timer.flip(win)
+    timer.record(rec, trial)
+
+
+rec = TrialRecorder(create_database(exp, trials=2),
+                    extra_columns=frame_columns)
+timer = FrameTimer(exp['frm']['time'])
+
+# on time
+run_trial(rec, 1, timer, FakeWindow())
+print('target duration: ', rec[1, 'targetDur'])
+print('SMI duration: ', rec[1, 'SMIDur'])
+print('timing error: ', rec[1, 'timingError'])
+assert np.isclose(rec[1, 'targetDur'], 10.)
+assert np.isclose(rec[1, 'SMIDur'], 20.)
+assert rec[1, 'timingError'] == 0 and rec[1, 'droppedFrames'] == 0
+
+# the frame after target onset is late - target lasts two frames
+target_frame = rec[2, 'fixTime'] + 1
+run_trial(rec, 2, timer, FakeWindow(drop=[target_frame]))
+print('target duration: ', rec[2, 'targetDur'])
+print('timing error: ', rec[2, 'timingError'])
+assert np.isclose(rec[2, 'targetDur'], 20.)
+assert rec[2, 'timingError'] == 1 and rec[2, 'droppedFrames'] == 1
+
+flips = timer.phase_times()
+assert len(flips['target']) == 1 and len(flips['mask']) == 20
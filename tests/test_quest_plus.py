@@ -0,0 +1,154 @@
+from __future__ import print_function
+import numpy as np
+from weibull import QuestPlus, weibull, from_db
+
+# construct Quest+ grids as in gabcon
+stim_params = from_db(np.arange(-20, 3.1, 0.35))
+thresholds = np.logspace(np.log10(0.01), np.log10(1.5), num=50)
+slopes = np.logspace(np.log10(0.15), np.log10(20.), num=50)
+lapses = np.arange(0., 0.06, 0.01)
+qp = QuestPlus(stim_params, [thresholds, slopes, lapses], function=weibull)
+
+# broadcast likelihoods should be the same as computed in a loop
+loop_lik = np.zeros(qp.likelihoods.shape)
+for p in range(qp.param_domain.shape[0]):
+    loop_lik[:, p] = weibull(stim_params, qp.param_domain[p, :])
+print('max likelihood difference: ', np.abs(loop_lik - qp.likelihoods).max())
+assert np.allclose(loop_lik, qp.likelihoods)
+
+# simulate a session and check float32 against float64
+from weibull import Weibull, check_dtype_accuracy
+observer = Weibull(kind='weibull')
+observer.params = [0.2, 6.5, 0.03]
+contrast, contrasts, responses = stim_params[30], list(), list()
+for trial in range(100):
+    response = int(np.random.rand() < observer.predict(contrast))
+    contrasts.append(contrast)
+    responses.append(response)
+    qp.update(contrast, response)
+    contrast = qp.next_contrast()
+
+accuracy = check_dtype_accuracy(stim_params, [thresholds, slopes, lapses],
+                                contrasts, responses, dtype='float32')
+print('float32 vs float64: ', accuracy)
+assert accuracy['max_posterior_diff'] < 1e-4
+
+# expected entropy of a block should agree with brute force enumeration
+# of all response sequences
+from itertools import product
+block = stim_params[[20, 30, 35]]
+brute_entropy = 0.
+for responses in product([1, 0], repeat=len(block)):
+    joint = qp.posterior.copy()
+    for contrast, response in zip(block, responses):
+        lik = qp.likelihoods[np.nonzero(stim_params == contrast)[0][0]]
+        joint *= lik if response else 1. - lik
+    norm = joint.sum()
+    post = joint[joint > 0] / norm
+    brute_entropy -= norm * (post * np.log(post)).sum()
+print('block entropy: ', qp.compute_entropy(block), brute_entropy)
+assert np.allclose(qp.compute_entropy(block), brute_entropy)
+
+# editing only a constant of the psychometric function should invalidate
+# cached likelihood tables
+import tempfile
+cache_dir = tempfile.mkdtemp()
+source = '''
+def psychometric(x, params):
+    return 0.5 + 0.5 * weibull(x, params, chance_level={})
+'''
+for chance_level in [0., 0.1]:
+    namespace = dict(weibull=weibull)
+    exec(source.format(chance_level), namespace)
+    cached_qp = QuestPlus(stim_params, [thresholds, slopes, lapses],
+                          function=namespace['psychometric'],
+                          cache_dir=cache_dir)
+    expected = 0.5 + 0.5 * weibull(stim_params, qp.param_domain[100],
+                                   chance_level=chance_level)
+    assert np.allclose(cached_qp.likelihoods[:, 100], expected)
+
+# outcome entropy table is built (and cached) only when entropy is needed
+assert cached_qp._cell_entropy_table is None
+cached_qp.update(stim_params[30], 1)
+assert cached_qp._cell_entropy_table is None
+cached_qp.next_contrast()
+assert isinstance(cached_qp._cell_entropy_table, np.memmap)
+
+# pruned next_contrast should agree with the full computation, both when
+# tables are gathered on the support and when the support is too large
+# and the full table is used
+full_qp = QuestPlus(stim_params, [thresholds, slopes, lapses])
+pruned_qps = [QuestPlus(stim_params, [thresholds, slopes, lapses],
+                        prune=1e-12, max_support=max_support)
+              for max_support in [1., 0.1]]
+contrast = stim_params[30]
+for trial in range(300):
+    response = int(np.random.rand() < observer.predict(contrast))
+    for this_qp in [full_qp] + pruned_qps:
+        this_qp.update(contrast, response)
+    contrast = full_qp.next_contrast()
+    for this_qp in pruned_qps:
+        # contrasts with (almost) equal expected entropy may be swapped
+        pruned_contrast = this_qp.next_contrast()
+        assert np.allclose(this_qp.entropy, full_qp.entropy, atol=1e-8)
+        assert np.isclose(full_qp.entropy[stim_params == pruned_contrast][0],
+                          full_qp.entropy.min(), atol=1e-8)
+print('support after 300 trials: ', pruned_qps[0].support.shape[0])
+
+# contrast precomputed during the trial should be used by next_contrast
+# (and agree with computing it after the update) in both posterior modes
+for log_space in [False, True]:
+    pre_qp = QuestPlus(stim_params, [thresholds, slopes, lapses],
+                       log_space=log_space)
+    ref_qp = QuestPlus(stim_params, [thresholds, slopes, lapses],
+                       log_space=log_space)
+    contrast = stim_params[30]
+    for trial in range(30):
+        pre_qp.precompute_next(contrast)
+        response = int(np.random.rand() < observer.predict(contrast))
+        pre_qp.update(contrast, response)
+        ref_qp.update(contrast, response)
+        assert pre_qp._precomputed is not None
+        pre_qp._precomputed['thread'].join()
+
+        # computing entropy again would fail
+        pre_qp._expected_entropy = None
+        contrast = pre_qp.next_contrast()
+        del pre_qp._expected_entropy
+        assert contrast == ref_qp.next_contrast()
+    print('precomputed contrasts used, log_space: ', log_space)
+
+# BatchQuestPlus should give the same results as separate QuestPlus
+# objects (observers are processed in chunks of two)
+from weibull import BatchQuestPlus
+observer_params = [[0.05, 3., 0.01], [0.2, 6.5, 0.03], [0.5, 1.5, 0.],
+                   [0.1, 10., 0.05], [0.9, 2., 0.02]]
+n_param = qp.param_domain.shape[0]
+batch = BatchQuestPlus(stim_params, [thresholds, slopes, lapses],
+                       len(observer_params), max_cells=2 * n_param)
+single = [QuestPlus(stim_params, [thresholds, slopes, lapses])
+          for params in observer_params]
+observers = list()
+for params in observer_params:
+    observers.append(Weibull(kind='weibull'))
+    observers[-1].params = params
+
+batch_contrasts = np.repeat(stim_params[30], len(observers))
+for trial in range(40):
+    responses = [int(np.random.rand() < obs.predict(contrast))
+                 for obs, contrast in zip(observers, batch_contrasts)]
+    batch.update(batch_contrasts, responses)
+    batch_contrasts = batch.next_contrast()
+    for obs_idx, this_qp in enumerate(single):
+        this_qp.update(batch.stim_history[-1][obs_idx], responses[obs_idx])
+        this_qp.next_contrast()
+        assert np.allclose(batch.posterior[obs_idx], this_qp.posterior)
+        assert np.allclose(batch.entropy[obs_idx], this_qp.entropy)
+        assert np.isclose(this_qp.entropy[stim_params ==
+                                          batch_contrasts[obs_idx]][0],
+                          this_qp.entropy.min())
+for select in ['mode', 'mean']:
+    assert np.allclose(batch.get_fit_params(select=select),
+                       [this_qp.get_fit_params(select=select)
+                        for this_qp in single])
+print('batch fit params: ', batch.get_fit_params())
@@ -0,0 +1,116 @@
+from __future__ import print_function
+import os
+import tempfile
+import numpy as np
+from trialdata import create_database, TrialRecorder, TrialJournal
+from procedure import (stages, create_staircase, load_session,
+                       session_trials, replay_staircase, main_c_plan,
+                       restore_main_c, apply_contrast_steps)
+
+# construct exp
+exp = dict()
+exp['targetTime']  = [1]
+exp['SMI']         = [2]
+exp['fixTimeLim']  = [0.75, 2.5]
+exp['maskTime']    = [20]
+exp['orientation'] = [0, 45, 90, 135]
+exp['frm'] = dict()
+exp['frm']['time'] = 10
+
+data_dir = tempfile.mkdtemp()
+rnd = np.random.RandomState(0)
+
+# there is nothing to resume without a journal
+assert load_session(os.path.join(data_dir, 'missing.jsonl'), '') is None
+part_c_db = lambda: TrialRecorder(create_database(
+    exp, combine_with=('opacity', [0.05, 0.1, 0.15, 0.2, 0.25]), rep=4,
+    shuffle_in_reps=True, numerate_steps=True))
+assert restore_main_c(part_c_db(), None) == (None, 1)
+
+
+# session interrupted during Quest+
+# --------------------------------
+journal_path = os.path.join(data_dir, 'S01_j_1.jsonl')
+state_path = os.path.join(data_dir, 'S01_s_1.jsonl')
+staircase = create_staircase(25)
+fitting_db = TrialRecorder(create_database(exp, trials=60),
+                           extra_columns={'trial_type': 'object'})
+with TrialJournal(journal_path) as journal:
+    with TrialJournal(state_path) as states:
+        trial = 1
+        for contrast in staircase:
+            if trial > 20:
+                break
+            fitting_db[trial, 'opacity'] = contrast
+            fitting_db[trial, 'ifcorrect'] = int(rnd.rand() < 0.7)
+            fitting_db[trial, 'trial_type'] = 'staircase'
+            journal.write_trial(fitting_db, trial, stage='staircase')
+            staircase.addResponse(fitting_db[trial, 'ifcorrect'])
+            states.write(dict(stage='staircase', trial=trial))
+            trial += 1
+        for trial in range(trial, trial + 5):
+            fitting_db[trial, 'opacity'] = 0.1
+            fitting_db[trial, 'ifcorrect'] = int(rnd.rand() < 0.7)
+            fitting_db[trial, 'trial_type'] = 'Quest+'
+            journal.write_trial(fitting_db, trial, stage='Quest+')
+            states.write(dict(stage='Quest+', trial=trial))
+
+session = load_session(journal_path, state_path)
+print('resumed stage: ', stages[session['stage']])
+assert session['stage'] == stages.index('Quest+')
+
+# fitting trials are restored
+restored_db = TrialRecorder(create_database(exp, trials=60),
+                            extra_columns={'trial_type': 'object'})
+fitting_trials = session_trials(session, stages[1:4])
+restored_db.fill(fitting_trials)
+assert fitting_trials.shape[0] == 25
+for col in ['opacity', 'ifcorrect', 'trial_type', 'fixTime']:
+    assert (restored_db.column(col)[:25] == fitting_db.column(col)[:25]).all()
+
+# staircase is in the same state as before the crash
+restored_staircase = replay_staircase(create_staircase(25), session_trials(
+    session, ['staircase']).ifcorrect.values)
+print('staircase next contrast: ', restored_staircase._nextIntensity)
+assert restored_staircase._nextIntensity == staircase._nextIntensity
+assert restored_staircase.data == staircase.data
+assert (restored_staircase.reversalIntensities ==
+        staircase.reversalIntensities)
+
+
+# session interrupted during part c
+# ---------------------------------
+journal_path = os.path.join(data_dir, 'S01_j_2.jsonl')
+state_path = os.path.join(data_dir, 'S01_s_2.jsonl')
+db_c = part_c_db()
+contrasts = np.array([0.05, 0.1, 0.15, 0.2, 0.25])
+with TrialJournal(journal_path) as journal:
+    with TrialJournal(state_path) as states:
+        states.write(main_c_plan(db_c))
+        for i in range(1, 31):
+            db_c[i, 'response'] = 'f'
+            db_c[i, 'ifcorrect'] = int(rnd.rand() < 0.7)
+            journal.write_trial(db_c, i, stage='main c')
+
+            # contrast steps change after trial 20
+            if i == 20:
+                change = np.array([True, False, True, False, False])
+                contrasts[change] *= 1.1
+                apply_contrast_steps(db_c.column('step', start=i + 1),
+                                     db_c.column('opacity', start=i + 1),
+                                     contrasts, change)
+            states.write(dict(stage='main c', trial=i, contrasts=contrasts))
+
+session = load_session(journal_path, state_path)
+assert session['stage'] == stages.index('main c')
+
+# order of trials, presented trials and contrast steps are restored
+restored_c = part_c_db()
+resumed_contrasts, next_trial = restore_main_c(restored_c, session)
+print('resumed contrasts: ', resumed_contrasts, 'next trial: ', next_trial)
+assert next_trial == 31
+assert np.allclose(resumed_contrasts, contrasts)
+for col in ['fixTime', 'orientation', 'step', 'opacity']:
+    assert np.allclose(restored_c.column(col), db_c.column(col))
+for col in ['response', 'ifcorrect']:
+    assert (restored_c.column(col)[:30] == db_c.column(col)[:30]).all()
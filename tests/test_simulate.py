@@ -0,0 +1,14 @@
+from __future__ import print_function
+from simulate import simulate_session
+
+# one headless run of the whole procedure
+results = simulate_session(observer_params=(0.2, 6.5, 0.03), seed=23)
+print('fitting trials: ', results['fitting'].shape[0])
+print('part c trials: ', results['main'].shape[0])
+print('final contrast steps: ', results['contrasts'])
+print('simulated duration (min): ', results['duration'] / 60.)
+print(results['main'].groupby('step').ifcorrect.mean())
+
+# the same seed gives the same session
+results2 = simulate_session(observer_params=(0.2, 6.5, 0.03), seed=23)
+assert (results['main'].opacity == results2['main'].opacity).all()
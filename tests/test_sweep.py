@@ -0,0 +1,35 @@
+from __future__ import print_function
+import os
+import tempfile
+import numpy as np
+from sweep import sweep_tasks, run_sweep, read_sweep
+
+# small Quest+ grid and short sessions to keep the sweep fast
+settings = [{'QUEST plus trials': 20, 'thresh opt trials': 10,
+             'thresholds': np.logspace(np.log10(0.01), np.log10(1.5), num=15),
+             'slopes': np.logspace(np.log10(0.15), np.log10(20.), num=10),
+             'QUEST plus axis': None}]
+tasks = sweep_tasks([[0.2, 6.5, 0.03], [0.1, 3., 0.01]], settings,
+                    n_repetitions=3)
+
+
+if __name__ == '__main__':
+    # whole sweep at once
+    full_dir = tempfile.mkdtemp()
+    assert run_sweep(tasks, full_dir, n_jobs=2, base_seed=7,
+                     run_main_c=False, write_every=2) == len(tasks)
+    full = read_sweep(full_dir)
+    print(full[['task_id', 'seed', 'est_threshold', 'est_slope']])
+
+    # interrupted sweep (only some tasks finished) resumed with all tasks
+    # gives the same results and does not run finished tasks again
+    resumed_dir = tempfile.mkdtemp()
+    run_sweep(tasks[:4], resumed_dir, n_jobs=1, base_seed=7,
+              run_main_c=False)
+    assert run_sweep(tasks, resumed_dir, n_jobs=2, base_seed=7,
+                     run_main_c=False) == len(tasks) - 4
+    assert run_sweep(tasks, resumed_dir, n_jobs=2, base_seed=7,
+                     run_main_c=False) == 0
+    resumed = read_sweep(resumed_dir)
+    assert resumed.shape[0] == len(tasks)
+    assert resumed[full.columns].equals(full)
@@ -0,0 +1,67 @@
+from __future__ import print_function
+import os
+import tempfile
+import numpy as np
+from exputils import create_database, TrialRecorder, TrialJournal, read_journal
+
+# construct exp
+exp = dict()
+exp['targetTime']  = [1]
+exp['SMI']         = [2]
+exp['fixTimeLim']  = [0.75, 2.5]
+exp['maskTime']    = [20]
+exp['orientation'] = [0, 45, 90, 135]
+exp['frm'] = dict()
+exp['frm']['time'] = 10
+
+rec = TrialRecorder(create_database(exp, trials=20),
+                    extra_columns={'trial_type': 'object'})
+# trials outside of the record raise IndexError (do not wrap around)
+for trial in [0, 21]:
+    try:
+        rec[trial, 'opacity'] = 0.5
+        raise AssertionError('trial {} should be out of range'.format(trial))
+    except IndexError:
+        pass
+
+path = os.path.join(tempfile.mkdtemp(), 'journal.jsonl')
+with TrialJournal(path) as journal:
+    for trial in range(1, 11):
+        rec[trial, 'opacity'] = 0.1 * trial
+        rec[trial, 'response'] = 'f'
+        rec[trial, 'ifcorrect'] = trial % 2
+        rec[trial, 'trial_type'] = 'Quest+'
+        journal.write_trial(rec, trial, stage='Quest+')
+
+# simulate crash during writing of the next trial
+with open(path, 'a') as f:
+    f.write('{"trial": 11, "opac')
+
+df = read_journal(path)
+print(df)
+assert df.shape[0] == 10
+assert np.allclose(df.opacity.values, rec.column('opacity')[:10])
+assert (df.ifcorrect.values == rec.to_df().ifcorrect.values[:10]).all()
+
+# resumed session appends to the journal after the incomplete line
+with TrialJournal(path) as journal:
+    for trial in range(11, 16):
+        rec[trial, 'opacity'] = 0.1 * trial
+        rec[trial, 'response'] = 'j'
+        rec[trial, 'ifcorrect'] = trial % 2
+        rec[trial, 'trial_type'] = 'Quest+'
+        journal.write_trial(rec, trial, stage='Quest+')
+
+df = read_journal(path)
+assert df.shape[0] == 15
+assert (df.trial.values == np.arange(1, 16)).all()
+assert np.allclose(df.opacity.values, rec.column('opacity')[:15])
+
+# an unreadable line in the middle does not hide the following trials
+with open(path, 'r') as f:
+    lines = f.readlines()
+lines[4] = lines[4][:10] + '\n'
+with open(path, 'w') as f:
+    f.writelines(lines)
+df = read_journal(path)
+assert df.shape[0] == 14 and df.trial.values[-1] == 15
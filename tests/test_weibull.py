@@ -0,0 +1,78 @@
+from __future__ import print_function
+import numpy as np
+from weibull import Weibull
+
+# closed-form inverse should agree with predict
+corrs = np.linspace(0.55, 0.95, num=9)
+for kind, params in [('weibull', [0.2, 6.5, 0.03]), ('weibull', [0.05, 1.2]),
+                     ('weibull_db', [-8., 3., 0.02])]:
+    w = Weibull(kind=kind)
+    w.params = params
+    contrasts = w.get_threshold(corrs)
+    print(kind, 'max correctness difference: ',
+        np.abs(w.predict(contrasts) - corrs).max())
+    assert np.allclose(w.predict(contrasts), corrs)
+
+    # correctness outside of function range is clipped
+    assert np.isfinite(w.get_threshold([0.4, 1.])).all()
+
+# analytic log-likelihood gradient should agree with numerical one
+from scipy.optimize import check_grad
+x = np.random.uniform(0.02, 0.5, size=200)
+for params in [[0.2, 6.5, 0.03], [0.2, 3.]]:
+    w = Weibull(kind='weibull')
+    w.params = params
+    y = (np.random.rand(200) < w.predict(x)).astype('float')
+    w.fit(x, y, params)
+    err = check_grad(lambda p: w.loglik_grad(p)[0],
+                     lambda p: w.loglik_grad(p)[1], np.array(params) * 1.1)
+    print('gradient error: ', err)
+    assert err < 1e-3
+
+# bootstrap needs data - parameters set by hand are not enough
+no_data = Weibull(kind='weibull')
+no_data.params = [0.2, 6.5, 0.03]
+try:
+    no_data.bootstrap(n_boot=10, n_jobs=1)
+    raise AssertionError('bootstrap without data should fail')
+except ValueError:
+    pass
+
+# bootstrap intervals should contain the fitted parameters
+boot = w.bootstrap(n_boot=100, corr=[0.6, 0.9], n_jobs=1, seed=0)
+print('bootstrap params ci: ', boot['params_ci'])
+assert boot['params'].shape == (100, 2)
+assert boot['thresholds_ci'].shape == (2, 2)
+assert ((boot['params_ci'][0] <= w.params) &
+        (w.params <= boot['params_ci'][1])).all()
+
+# for a well-conditioned simulated observer (800 trials spanning the whole
+# psychometric function) intervals should be narrow and cover the true
+# parameters in most simulated experiments
+rnd = np.random.RandomState(0)
+true_params = np.array([0.2, 3.])
+observer = Weibull(kind='weibull')
+observer.params = true_params
+covered, widths = list(), list()
+for experiment in range(20):
+    sim_x = rnd.uniform(0.02, 0.5, size=800)
+    sim_y = (rnd.rand(800) < observer.predict(sim_x)).astype('float')
+    sim_w = Weibull(kind='weibull')
+    sim_w.fit(sim_x, sim_y, [0.3, 2.])
+    low, high = sim_w.bootstrap(n_boot=200, n_jobs=1,
+                                seed=experiment)['params_ci']
+    covered.append((low <= true_params) & (true_params <= high))
+    widths.append(high - low)
+coverage, max_width = np.mean(covered, axis=0), np.max(widths, axis=0)
+print('bootstrap coverage: ', coverage, 'max ci width: ', max_width)
+assert (coverage >= 0.8).all()
+assert max_width[0] < 0.1 and max_width[1] < 6.
+
+# fitting groups in parallel should give the same result as in one process
+import pandas as pd
+from weibull import fit_groups
+df = pd.concat([pd.DataFrame(dict(subject=subj, opacity=x, ifcorrect=y))
+                for subj in range(4)])
+params = fit_groups(df, 'subject', corr=[0.6, 0.9], n_jobs=1)
+assert params.equals(fit_groups(df, 'subject', corr=[0.6, 0.9], n_jobs=2))
+print(params)
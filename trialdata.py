@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+# trial data utilities that do not need psychopy (or a display) - trial
+# database, TrialRecorder, frame timing, the trial journal and a file lock;
+# used by exputils, dataset and headless simulations
+
+import os
+import json
+import time
+import warnings
+
+import numpy  as np
+import pandas as pd
+
+
+def ms2frames(times, frame_time):
+	tp = type(times)
+	if isinstance(times, list):
+	    frms = list()
+	    for t in times:
+	        frms.append(int(round(t / frame_time)))
+	elif isinstance(times, dict):
+	    frms = dict()
+	    for t in times.keys():
+	        frms[t] = int(round(times[t] / frame_time))
+	elif isinstance(times, np.ndarray):
+		frms = np.array(np.round(times / frame_time), dtype=int)
+	else:
+		raise ValueError('times has to be list, dict or numpy ndarray.')
+	return frms
+
+
+# TODO
+# - [ ] add some of functionality below to chainsaw
+def create_database(exp, trials=None, rep=None, combine_with=None,
+					shuffle_in_reps=False, numerate_steps=False):
+	# define column names:
+	column_names = ['time', 'fixTime', 'targetTime', 'SMI', 'maskTime',
+					'opacity', 'orientation', 'response', 'ifcorrect', 'RT']
+	from_exp = ['targetTime', 'SMI', 'maskTime']
+	if numerate_steps:
+		column_names = column_names[:6] + ['step'] + column_names[6:]
+
+	# how many times each combination should be presented
+	if not trials and not rep:
+		trials = 140
+
+	# generate all trial combinations as indices to orientations and
+	# combined values (combination index gives the step number)
+	orientations = np.asarray(exp['orientation'], dtype='int64')
+	n_values = 1 if not combine_with else len(combine_with[1])
+	trials_in_rep = len(orientations) * n_values
+	num_rep = (int(rep) if not rep is None else
+			   int(np.ceil(trials / float(trials_in_rep))))
+	num_trials = trials_in_rep * num_rep
+
+	# shuffle trials (within repetitions or all)
+	if shuffle_in_reps:
+		order = np.argsort(np.random.rand(num_rep, trials_in_rep), axis=1)
+		cmb_idx = order.ravel() % trials_in_rep
+	else:
+		cmb_idx = np.random.permutation(num_trials) % trials_in_rep
+
+	if not trials:
+		trials = num_trials
+	cmb_idx = cmb_idx[:trials]
+	num_trials = len(cmb_idx)
+
+	# fill typed columns
+	time_limits = exp['fixTimeLim']
+	fix_ms = np.random.uniform(low=time_limits[0], high=time_limits[1],
+							   size=num_trials) * 1000
+	columns = dict(
+		time=np.zeros(num_trials, dtype='float64'),
+		fixTime=ms2frames(fix_ms, exp['frm']['time']).astype('int32'),
+		opacity=np.zeros(num_trials, dtype='float64'),
+		orientation=orientations[cmb_idx // n_values],
+		response=np.zeros(num_trials, dtype='object'),
+		ifcorrect=np.zeros(num_trials, dtype='int32'),
+		RT=np.zeros(num_trials, dtype='float64'))
+	for col in from_exp:
+		columns[col] = np.full(num_trials, exp[col][0], dtype='int32')
+	if combine_with:
+		values = np.asarray(combine_with[1])
+		if combine_with[0] in columns:
+			values = values.astype(columns[combine_with[0]].dtype)
+		columns[combine_with[0]] = values[cmb_idx % n_values]
+	if numerate_steps:
+		columns['step'] = (cmb_idx % n_values + 1).astype('int32')
+
+	return pd.DataFrame(columns, index=np.arange(1, num_trials + 1),
+						columns=column_names)
+
+
+class TrialRecorder(object):
+	'''Preallocated record of trial data - trial fields are written to a
+	structured numpy array instead of DataFrame cells, a DataFrame is created
+	only with ``to_df`` (when saving or analysing).
+
+	example:
+	--------
+	rec = TrialRecorder(create_database(exp, trials=600),
+						extra_columns={'trial_type': 'object'})
+	rec[1, 'opacity'] = 0.5
+	opacity = rec[1, 'opacity']
+	df = rec.to_df()
+	'''
+	def __init__(self, db, extra_columns=None):
+		extra_columns = dict() if extra_columns is None else extra_columns
+		self.index = db.index.values.copy()
+		self.first = self.index[0]
+		self.columns = list(db.columns) + [col for col in extra_columns
+										   if col not in db.columns]
+
+		# numeric columns keep their dtype, everything else is stored as
+		# python objects
+		values = {col: db[col].to_numpy() for col in db.columns}
+		dtypes = list()
+		for col in self.columns:
+			if col in values:
+				dtype = values[col].dtype
+			else:
+				dtype = np.dtype(extra_columns[col])
+			if dtype.kind not in 'biuf':
+				dtype = np.dtype('object')
+			dtypes.append((str(col), dtype))
+		self.data = np.zeros(len(self.index), dtype=dtypes)
+		for col in values:
+			self.data[col] = values[col]
+
+		# column views for fast access
+		self._columns = {col: self.data[col] for col in self.columns}
+
+	def __len__(self):
+		return len(self.index)
+
+	def _position(self, trial):
+		'''Position of trial in the record (trials outside the record
+		raise IndexError instead of wrapping around).'''
+		if trial < self.first or trial >= self.first + len(self.index):
+			raise IndexError('Trial {} is outside of the record (trials {} - '
+							 '{}).'.format(trial, self.first,
+										   self.first + len(self.index) - 1))
+		return trial - self.first
+
+	def __getitem__(self, key):
+		trial, col = key
+		return self._columns[col][self._position(trial)]
+
+	def __setitem__(self, key, value):
+		trial, col = key
+		self._columns[col][self._position(trial)] = value
+
+	def column(self, col, start=None):
+		'''Column values (array view, writing to it changes the record),
+		optionally starting from trial ``start``.'''
+		if start is None:
+			return self._columns[col]
+		return self._columns[col][start - self.first:]
+
+	def fill(self, trials):
+		'''Write trials from a DataFrame with ``trial`` column (for example
+		trials read from a journal with ``read_journal``).'''
+		pos = trials['trial'].values.astype('int64') - self.first
+		for col in self.columns:
+			if col in trials.columns:
+				self._columns[col][pos] = trials[col].values
+
+	def row(self, trial):
+		'''Values of all columns for given trial as a dict.'''
+		pos = self._position(trial)
+		return {col: self._columns[col][pos] for col in self.columns}
+
+	def to_df(self):
+		'''Copy of the record as a DataFrame.'''
+		return pd.DataFrame({col: self._columns[col].copy()
+							 for col in self.columns}, index=self.index.copy(),
+							columns=self.columns)
+
+
+# phases of a trial timed by FrameTimer and trial record columns it fills
+frame_phases = ['fix', 'target', 'SMI', 'mask', 'offset']
+frame_columns = {'fixOnset': 'float64', 'targetOnset': 'float64',
+				 'SMIOnset': 'float64', 'maskOnset': 'float64',
+				 'offsetTime': 'float64', 'targetDur': 'float64',
+				 'SMIDur': 'float64', 'droppedFrames': 'int64',
+				 'timingError': 'int64'}
+
+
+class FrameTimer(object):
+	'''Records flip timestamps of every frame of a trial, split into phases
+	(fixation, target, SMI, mask and mask offset). Timestamps are written to
+	a preallocated array, so timing adds almost nothing to the flip loop.
+
+	example:
+	--------
+	timer = FrameTimer(exp['frm']['time'])
+	db = TrialRecorder(db, extra_columns=frame_columns)
+	present_trial(trial, db=db, timer=timer)
+	flips = timer.phase_times()
+	'''
+	def __init__(self, frame_time, max_frames=1000):
+		# frame time in ms, timestamps in seconds
+		self.frame_time = frame_time
+		self.times = np.zeros(max_frames)
+		self.starts = dict()
+		self.n = 0
+
+	def reset(self):
+		self.starts = dict()
+		self.n = 0
+
+	def phase(self, name):
+		'''Mark that following flips belong to phase ``name``.'''
+		self.starts[name] = self.n
+
+	def flip(self, win):
+		if self.n == self.times.shape[0]:
+			self.times = np.concatenate([self.times, np.zeros_like(self.times)])
+		t = win.flip()
+		self.times[self.n] = t
+		self.n += 1
+		return t
+
+	def _phase_range(self, name):
+		start = self.starts[name]
+		later = [self.starts[ph] for ph in frame_phases
+				 if ph in self.starts and self.starts[ph] > start]
+		return start, min(later) if later else self.n
+
+	def onset(self, name):
+		'''Timestamp of the first flip of a phase (first flip of the next
+		phase if the phase had no frames).'''
+		if name not in self.starts or self.starts[name] >= self.n:
+			return np.nan
+		return self.times[self.starts[name]]
+
+	def phase_times(self):
+		'''Flip timestamps of the last trial as a dict of lists (one list
+		per phase).'''
+		times = dict()
+		for name in frame_phases:
+			if name in self.starts:
+				start, end = self._phase_range(name)
+				times[name] = self.times[start:end].tolist()
+		return times
+
+	def dropped_frames(self):
+		'''Number of frames missed between the fixation onset and the last
+		mask frame.'''
+		if 'fix' not in self.starts:
+			return 0
+		end = self.starts.get('offset', self.n)
+		intervals = np.diff(self.times[self.starts['fix']:end])
+		missed = np.round(intervals / (self.frame_time / 1000.)) - 1
+		return int(missed[missed > 0].sum())
+
+	def record(self, rec, trial):
+		'''Write phase onsets, measured target and SMI durations (in ms),
+		number of dropped frames and timing error flag of the last trial to
+		TrialRecorder ``rec`` (that has ``frame_columns``). Timing error
+		means that target or SMI duration differs from the planned number
+		of frames by more than half a frame.'''
+		onsets = {name: self.onset(name) for name in frame_phases}
+		for name, col in zip(frame_phases, ['fixOnset', 'targetOnset',
+			'SMIOnset', 'maskOnset', 'offsetTime']):
+			rec[trial, col] = onsets[name]
+		target_dur = (onsets['SMI'] - onsets['target']) * 1000.
+		smi_dur = (onsets['mask'] - onsets['SMI']) * 1000.
+		rec[trial, 'targetDur'] = target_dur
+		rec[trial, 'SMIDur'] = smi_dur
+		rec[trial, 'droppedFrames'] = self.dropped_frames()
+
+		tolerance = self.frame_time / 2.
+		planned_target = rec[trial, 'targetTime'] * self.frame_time
+		planned_smi = rec[trial, 'SMI'] * self.frame_time
+		error = not (abs(target_dur - planned_target) <= tolerance and
+					 abs(smi_dur - planned_smi) <= tolerance)
+		rec[trial, 'timingError'] = int(error)
+
+
+class TrialJournal(object):
+	'''Append-only journal of trials - one JSON line per trial. Trials
+	written to the journal survive a crash of the experiment, the journal
+	can be read back with ``read_journal``.
+
+	Parameters
+	----------
+	path : str
+		Path to the journal file (``.jsonl``). Records are appended if the
+		file exists, an incomplete last line (left by a crash during
+		writing) is removed first.
+	fsync_every : int
+		Force the records to disk (``os.fsync``) every ``fsync_every``
+		records. ``1`` syncs after each trial, ``0`` only flushes python
+		buffers (the OS decides when data reach the disk).
+	'''
+	def __init__(self, path, fsync_every=1):
+		self.path = path
+		self.fsync_every = fsync_every
+		self.n_records = 0
+		_truncate_partial_line(path)
+		self._file = open(path, 'a')
+
+	def write(self, record):
+		'''Append one record (dict).'''
+		line = json.dumps({key: _json_value(val)
+						   for key, val in record.items()})
+		self._file.write(line + '\n')
+		self._file.flush()
+		self.n_records += 1
+		if self.fsync_every and self.n_records % self.fsync_every == 0:
+			os.fsync(self._file.fileno())
+
+	def write_trial(self, rec, trial, **fields):
+		'''Append trial from TrialRecorder ``rec`` with additional fields
+		(for example ``stage='Quest+'``).'''
+		record = dict(trial=trial, **fields)
+		record.update(rec.row(trial))
+		self.write(record)
+
+	def close(self):
+		if not self._file.closed:
+			self._file.flush()
+			os.fsync(self._file.fileno())
+			self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def _truncate_partial_line(path):
+	'''Remove everything after the last newline in ``path`` so that new
+	records do not continue a line left incomplete by a crash.'''
+	if not os.path.isfile(path):
+		return
+	with open(path, 'rb+') as f:
+		size = f.seek(0, os.SEEK_END)
+		end = size
+		while end > 0:
+			start = max(0, end - 4096)
+			f.seek(start)
+			newline = f.read(end - start).rfind(b'\n')
+			if newline >= 0:
+				end = start + newline + 1
+				break
+			end = start
+		if end < size:
+			warnings.warn('Removing incomplete last line of {}.'.format(path))
+			f.truncate(end)
+
+
+def _json_value(val):
+	if isinstance(val, (np.generic, np.ndarray)):
+		return val.tolist()
+	return val
+
+
+def read_journal(path, stage=None):
+	'''Read trial journal as a DataFrame (one row per trial), optionally
+	only trials of given ``stage``. Lines that cannot be parsed (an
+	incomplete line left by a crash during writing) are skipped with a
+	warning.'''
+	records = list()
+	n_bad = 0
+	with open(path, 'r') as f:
+		for line in f:
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				n_bad += 1
+	if n_bad > 0:
+		warnings.warn('Skipped {} unreadable line(s) in {}.'.format(
+			n_bad, path))
+	df = pd.DataFrame(records)
+	if stage is not None and 'stage' in df.columns:
+		df = df[df['stage'] == stage].reset_index(drop=True)
+	return df
+
+
+class FileLock(object):
+	'''Simple inter-process lock using exclusive creation of a lock file.
+	Lock files older than ``stale`` seconds (left by crashed processes) are
+	removed, so ``timeout`` has to be longer than ``stale``.'''
+	def __init__(self, path, timeout=60., stale=30., poll=0.01):
+		if timeout <= stale:
+			raise ValueError('timeout has to be longer than stale.')
+		self.path = path
+		self.timeout = timeout
+		self.stale = stale
+		self.poll = poll
+
+	def acquire(self):
+		start = time.time()
+		while True:
+			try:
+				fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+				os.write(fd, str(os.getpid()).encode('ascii'))
+				os.close(fd)
+				return
+			except OSError:
+				try:
+					if time.time() - os.path.getmtime(self.path) > self.stale:
+						os.remove(self.path)
+						continue
+				except OSError:
+					# lock was released in the meantime
+					continue
+				if time.time() - start > self.timeout:
+					raise RuntimeError('Could not acquire lock {}.'.format(
+						self.path))
+				time.sleep(self.poll)
+
+	def release(self):
+		os.remove(self.path)
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *args):
+		self.release()
@@ -289,3 +289,14 @@ def bin_points(x_pnts, y_pnts, min_bucket, split_bucket):
 				ii += 1
 		slices.extend(add_slices)
 	return slices
+
+
+def figure_to_image(fig, dpi=120):
+	'''Render figure to a PIL Image in memory (without writing a file).'''
+	from PIL import Image
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+	fig.set_dpi(dpi)
+	canvas = FigureCanvasAgg(fig)
+	canvas.draw()
+	return Image.fromarray(np.asarray(canvas.buffer_rgba()).copy())
@@ -10,13 +10,18 @@ from __future__ import absolute_import
 import os
 import sys
 import random
+import hashlib
+import threading
 from functools import partial
+from itertools import combinations_with_replacement
+from multiprocessing import Pool, cpu_count
 from copy import deepcopy
 
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 from scipy.optimize import minimize
+from scipy.special import xlogy
 
 from utils import trim, trim_df, round2step, reformat_params
 from viz import plot_weibull, plot_quest_plus
@@ -37,9 +42,13 @@ class Weibull:
     initparams = [1., 1.]
     w.fit(initparams)
     final_params = w.params
+
+    By default weibull and weibull_db kinds are fitted with bounded
+    L-BFGS-B using analytic gradient of the log-likelihood, generalized
+    logistic is fitted with Nelder-Mead.
     '''
 
-    def __init__(self, method='Nelder-Mead', kind='weibull', bounds=None,
+    def __init__(self, method=None, kind='weibull', bounds=None,
                  corr_at_thresh=0.75):
         self.x = None
         self.y = None
@@ -47,13 +56,6 @@ class Weibull:
         self.params = None
         self.corr_at_thresh = corr_at_thresh
 
-        # method (optimizer)
-        valid_methods = ('Nelder-Mead', 'L-BFGS-B', 'TNC', 'SLSQP')
-        if method in valid_methods:
-            self.method = method
-        else:
-            raise ValueError('method must be one of {}, got {} '
-                             'instead.'.format(valid_methods, method))
         # kind
         valid_kinds = ('weibull', 'weibull_db', 'generalized logistic')
         if kind in valid_kinds:
@@ -62,13 +64,27 @@ class Weibull:
             raise ValueError('kind must be one of {}, got {} '
                              'instead.'.format(valid_kinds, kind))
 
+        # method (optimizer)
+        valid_methods = ('Nelder-Mead', 'L-BFGS-B', 'TNC', 'SLSQP')
+        if method is None:
+            method = ('Nelder-Mead' if kind == 'generalized logistic'
+                      else 'L-BFGS-B')
+        if method in valid_methods:
+            self.method = method
+        else:
+            raise ValueError('method must be one of {}, got {} '
+                             'instead.'.format(valid_methods, method))
+
         min_float = sys.float_info.min
+        self._grad = None
         if self.kind == 'weibull':
             self._fun = weibull
+            self._grad = weibull_grad
             self.bounds = ((min_float, None), (min_float, None),
                            (min_float, 0.15)) if bounds is None else bounds
         elif self.kind == 'weibull_db':
             self._fun = weibull_db
+            self._grad = weibull_db_grad
             self.bounds = ((-40., None), (min_float, None),
                            (min_float, 0.15)) if bounds is None else bounds
         elif self.kind == 'generalized logistic':
@@ -107,6 +123,23 @@ class Weibull:
         return np.nansum(np.log(y_pred) * self.orig_y +
                       np.log(1 - y_pred) * (1 - self.orig_y)) * -1.
 
+    def loglik_grad(self, params):
+        '''Negative log-likelihood and its gradient with respect to params
+        (available for weibull and weibull_db kinds).'''
+        x, y = self._fit_data
+        if self.kind == 'weibull':
+            y_pred, grad = self._grad(x, params,
+                                      corr_at_thresh=self.corr_at_thresh)
+        else:
+            y_pred, grad = self._grad(x, params)
+
+        # keep predictions away from 0 and 1 so that log is finite
+        eps = 1e-12
+        y_pred = np.clip(y_pred, eps, 1 - eps)
+        loglik = -(y * np.log(y_pred) + (1 - y) * np.log(1 - y_pred)).sum()
+        dloglik = (y_pred - y) / (y_pred * (1 - y_pred))
+        return loglik, grad.dot(dloglik)
+
     def fit(self, x, y, initparams):
         self.x = x
         self.orig_y = y.copy()
@@ -115,13 +148,24 @@ class Weibull:
         self.y = self.drag(y)
 
         n_params = len(initparams)
+        bounds = self.bounds[:n_params]
         if self.method == 'Nelder-Mead':
             self.params = minimize(self.loglik_ned, initparams,
                                    method='Nelder-Mead')['x']
+        elif self._grad is not None:
+            # analytic gradient, trials with missing responses are ignored
+            x, y = np.asarray(x, dtype='float64'), np.asarray(
+                y, dtype='float64')
+            msk = ~np.isnan(y)
+            self._fit_data = x[msk], y[msk]
+            initparams = [clip_to_bounds(val, bound)
+                          for val, bound in zip(initparams, bounds)]
+            self.params = minimize(self.loglik_grad, initparams, jac=True,
+                                   method=self.method, bounds=bounds)['x']
         else:
             # use bounds
             self.params = minimize(self.loglik, initparams, method=self.method,
-                                   bounds=self.bounds[:n_params])['x']
+                                   bounds=bounds)['x']
 
     def _inverse(self, corrinput):
         invfun = lambda cntr: (corrinput - self.predict(cntr)) ** 2
@@ -130,7 +174,103 @@ class Weibull:
         return minimize(invfun, start_param, method='Nelder-Mead')['x'][0]
 
     def get_threshold(self, corr):
-        return list(map(self._inverse, corr))
+        '''Stimulus intensities corresponding to given correctness levels.
+
+        Uses closed-form inverse of the function for ``'weibull'`` and
+        ``'weibull_db'`` kinds (correctness levels outside of the range of
+        the function are clipped to its edges) and numerical search for
+        ``'generalized logistic'``.
+
+        Parameters
+        ----------
+        corr : float | array-like
+            Correctness levels.
+
+        Returns
+        -------
+        intensity : numpy array
+            Stimulus intensities (same shape as ``corr``).
+        '''
+        if self.kind == 'weibull':
+            return weibull_inverse(corr, self.params,
+                                   corr_at_thresh=self.corr_at_thresh)
+        elif self.kind == 'weibull_db':
+            return weibull_db_inverse(corr, self.params)
+        else:
+            corr = np.asarray(corr, dtype='float64')
+            return np.reshape(list(map(self._inverse, corr.ravel())),
+                              corr.shape)
+
+    def bootstrap(self, n_boot=1000, corr=None, kind='nonparametric',
+                  ci=0.95, n_jobs=None, seed=None):
+        '''Bootstrap confidence intervals for fitted parameters and
+        thresholds. Has to be run after ``fit``.
+
+        Parameters
+        ----------
+        n_boot : int
+            Number of bootstrap samples.
+        corr : array-like | None
+            Correctness levels to compute thresholds for. Defaults to
+            ``corr_at_thresh``.
+        kind : str
+            ``'nonparametric'`` - trials are resampled with replacement,
+            ``'parametric'`` - responses are simulated from the fitted
+            function at the original stimulus intensities.
+        ci : float
+            Confidence level of percentile intervals.
+        n_jobs : int | None
+            Number of processes used for refitting. Defaults to ``None`` -
+            all cores. ``1`` fits in the current process.
+        seed : int | None
+            Seed for generating bootstrap samples.
+
+        Returns
+        -------
+        boot : dict
+            ``'params'`` and ``'thresholds'`` - bootstrap distributions
+            (n_boot x n_params and n_boot x n_corr), ``'params_ci'`` and
+            ``'thresholds_ci'`` - lower and upper interval limits (2 x
+            n_params and 2 x n_corr).
+        '''
+        valid_kinds = ('nonparametric', 'parametric')
+        if kind not in valid_kinds:
+            raise ValueError('kind must be one of {}, got {} '
+                             'instead.'.format(valid_kinds, kind))
+        if self.x is None or self.params is None:
+            raise ValueError('Weibull has no fitted data - you have to call '
+                             '`fit` before bootstrapping.')
+        corr = [self.corr_at_thresh] if corr is None else corr
+
+        # resamples are generated at once, only fitting is parallelized
+        x, y = np.asarray(self.x, dtype='float64'), np.asarray(
+            self.orig_y, dtype='float64')
+        msk = ~np.isnan(y)
+        x, y = x[msk], y[msk]
+        rnd = np.random.RandomState(seed)
+        if kind == 'nonparametric':
+            idx = rnd.randint(0, len(x), size=(n_boot, len(x)))
+            boot_x, boot_y = x[idx], y[idx]
+        else:
+            boot_x = np.tile(x, (n_boot, 1))
+            boot_y = (rnd.rand(n_boot, len(x)) < self.predict(x)).astype(
+                'float64')
+
+        weibull_args = dict(method=self.method, kind=self.kind,
+                            bounds=self.bounds,
+                            corr_at_thresh=self.corr_at_thresh)
+        n_chunks = 1 if n_jobs == 1 else (n_jobs or cpu_count()) * 4
+        chunks = [(weibull_args, self.params, bx, by, corr) for bx, by in
+                  zip(np.array_split(boot_x, n_chunks),
+                      np.array_split(boot_y, n_chunks)) if len(bx) > 0]
+        results = _map_in_pool(_bootstrap_worker, chunks, n_jobs)
+
+        boot_params = np.concatenate([res[0] for res in results])
+        boot_thresh = np.concatenate([res[1] for res in results])
+        limits = [(1. - ci) / 2. * 100, (1. + ci) / 2. * 100]
+        return dict(params=boot_params, thresholds=boot_thresh,
+                    params_ci=np.percentile(boot_params, limits, axis=0),
+                    thresholds_ci=np.percentile(boot_thresh, limits, axis=0))
 
     def plot(self, x=None, pth='', ax=None, points=True, line=True,
              mean_points=False, min_bucket='adaptive', split_bucket='adaptive',
@@ -144,6 +284,109 @@ class Weibull:
             mean_points_color=mean_points_color, scale=scale)
 
 
+def _map_in_pool(worker, chunks, n_jobs):
+    '''Map worker over chunks in a process pool (or in the current process
+    when n_jobs is 1).'''
+    if n_jobs == 1:
+        return list(map(worker, chunks))
+    pool = Pool(processes=n_jobs)
+    try:
+        return pool.map(worker, chunks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _bootstrap_worker(args):
+    '''Refit Weibull to a chunk of bootstrap samples.'''
+    weibull_args, init_params, boot_x, boot_y, corr = args
+    w = Weibull(**weibull_args)
+    params, thresholds = list(), list()
+    for x, y in zip(boot_x, boot_y):
+        w.fit(x, y, init_params)
+        params.append(w.params)
+        thresholds.append(w.get_threshold(corr))
+    return np.array(params), np.array(thresholds)
+
+
+def fit_groups(df, by, x='opacity', y='ifcorrect', kind='weibull',
+               init_params=None, corr=None, n_jobs=None, **weibull_args):
+    '''Fit Weibull separately to each group of trials in a long-format
+    DataFrame (for example part c data of many subjects).
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Trials of all groups, one row per trial.
+    by : str | list of str
+        Grouping columns, for example ``['subject', 'step']``.
+    x : str
+        Stimulus intensity column.
+    y : str
+        Response correctness column (0 or 1, NaN for missing responses).
+    kind : str
+        Weibull kind.
+    init_params : list | None
+        Initial parameters for all groups. If ``None`` each group starts
+        with its median intensity as threshold, slope of 3 and lapse of
+        0.01 (threshold, slope and lapse are in dB for ``'weibull_db'``).
+    corr : array-like | None
+        Correctness levels to compute thresholds for.
+    n_jobs : int | None
+        Number of processes. Defaults to ``None`` - all cores.
+    **weibull_args
+        Additional arguments passed to Weibull (``method``, ``bounds``,
+        ``corr_at_thresh``).
+
+    Returns
+    -------
+    params : pandas DataFrame
+        One row per group: grouping columns, ``n_trials``, fitted
+        ``threshold``, ``slope`` and ``lapse``, negative log-likelihood
+        ``loglik`` and ``thresh_<corr>`` columns for requested correctness
+        levels.
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    weibull_args = dict(weibull_args, kind=kind)
+    groups = [(key if isinstance(key, tuple) else (key,),
+               group[x].values.astype('float64'),
+               group[y].values.astype('float64'))
+              for key, group in df.groupby(by, sort=True)]
+
+    n_chunks = 1 if n_jobs == 1 else (n_jobs or cpu_count()) * 4
+    chunks = [(weibull_args, init_params, corr,
+               [groups[idx] for idx in chunk])
+              for chunk in np.array_split(np.arange(len(groups)), n_chunks)
+              if len(chunk) > 0]
+    rows = sum(_map_in_pool(_fit_groups_worker, chunks, n_jobs), list())
+
+    columns = by + ['n_trials', 'threshold', 'slope', 'lapse', 'loglik']
+    if corr is not None:
+        columns += ['thresh_{}'.format(c) for c in corr]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _fit_groups_worker(args):
+    '''Fit Weibull to each group in a chunk of groups.'''
+    weibull_args, init_params, corr, groups = args
+    w = Weibull(**weibull_args)
+    rows = list()
+    for key, x, y in groups:
+        msk = ~np.isnan(y)
+        x, y = x[msk], y[msk]
+        init = (init_params if init_params is not None
+                else [np.median(x), 3., 0.01])
+        w.fit(x, y, init)
+        params = list(w.params) + [np.nan] * (3 - len(w.params))
+        y_pred = np.clip(w.predict(x), 1e-12, 1 - 1e-12)
+        loglik = -(y * np.log(y_pred) + (1 - y) * np.log(1 - y_pred)).sum()
+        row = list(key) + [len(x)] + params + [loglik]
+        if corr is not None:
+            row += list(w.get_threshold(corr))
+        rows.append(row)
+    return rows
+
+
 def outside_bounds(val, bounds):
     if bounds[0] is not None and val < bounds[0]:
         return True
@@ -152,6 +395,14 @@ def outside_bounds(val, bounds):
     return False
 
 
+def clip_to_bounds(val, bounds):
+    if bounds[0] is not None:
+        val = max(val, bounds[0])
+    if bounds[1] is not None:
+        val = min(val, bounds[1])
+    return val
+
+
 def weibull(x, params, corr_at_thresh=0.75, chance_level=0.5):
         # unpack params
         if len(params) == 3:
@@ -179,11 +430,144 @@ def weibull_db(contrast, params, guess=0.5):
         -10. ** (slope * (contrast - threshold) / 20.))
 
 
+def weibull_grad(x, params, corr_at_thresh=0.75, chance_level=0.5):
+    '''Weibull function and its gradient with respect to params.
+
+    Returns
+    -------
+    y : array
+        Weibull function values for x.
+    grad : array
+        Derivatives of y with respect to each of the params
+        (n_params x n_points).
+    '''
+    t, b, lapse = _unpack_params(params)
+    x = np.asarray(x, dtype='float64')
+    c = -np.log((1.0 - corr_at_thresh) / (1.0 - chance_level))
+    ratio = x / t
+    # exp(-700) is already 0 for practical purposes, clipping the exponent
+    # avoids inf * 0 in the gradient
+    with np.errstate(over='ignore'):
+        expo = np.minimum(c * ratio ** b, 700.)
+    exp_neg = np.exp(-expo)
+    y = (1 - lapse) - (1 - lapse - chance_level) * exp_neg
+
+    # chain rule through the exponent
+    dy_dexpo = (1 - lapse - chance_level) * exp_neg
+    grad = [dy_dexpo * -b * expo / t, dy_dexpo * xlogy(expo, ratio)]
+    if len(params) == 3:
+        grad.append(exp_neg - 1)
+    return y, np.array(grad)
+
+
+def weibull_db_grad(contrast, params, guess=0.5):
+    '''weibull_db function and its gradient with respect to params (see
+    ``weibull_grad``).'''
+    threshold, slope, lapse = _unpack_params(params)
+    contrast = np.asarray(contrast, dtype='float64')
+    with np.errstate(over='ignore'):
+        expo = np.minimum(10. ** (slope * (contrast - threshold) / 20.), 700.)
+    exp_neg = np.exp(-expo)
+    y = (1 - lapse) - (1 - lapse - guess) * exp_neg
+
+    dy_dexpo = (1 - lapse - guess) * exp_neg * expo * np.log(10.) / 20.
+    grad = [dy_dexpo * -slope, dy_dexpo * (contrast - threshold)]
+    if len(params) == 3:
+        grad.append(exp_neg - 1)
+    return y, np.array(grad)
+
+
+def _unpack_params(params):
+    if len(params) == 3:
+        return params
+    return list(params) + [0.]
+
+
+def _inverse_exponent(corr, lapse, guess):
+    '''Value of the exponent in Weibull function for given correctness
+    levels - correctness is clipped to the range of the function.'''
+    corr = np.asarray(corr, dtype='float64')
+    span = 1. - lapse - guess
+    margin = span * 1e-12
+    corr = np.clip(corr, guess + margin, 1. - lapse - margin)
+    return -np.log((1. - lapse - corr) / span)
+
+
+def weibull_inverse(corr, params, corr_at_thresh=0.75, chance_level=0.5):
+    '''Inverse of the weibull function - stimulus intensity for given
+    correctness levels.'''
+    t, b, lapse = _unpack_params(params)
+    k = ( -np.log((1.0 - corr_at_thresh) / (1.0 - chance_level)) ) \
+        ** (1.0 / b)
+    expo = _inverse_exponent(corr, lapse, chance_level)
+    return t / k * expo ** (1.0 / b)
+
+
+def weibull_db_inverse(corr, params, guess=0.5):
+    '''Inverse of the weibull_db function - contrast (in dB) for given
+    correctness levels.'''
+    threshold, slope, lapse = _unpack_params(params)
+    expo = _inverse_exponent(corr, lapse, guess)
+    return threshold + 20. / slope * np.log10(expo)
+
+
 # TODO:
 # - [ ] highlight lowest point in entropy in plot
 class QuestPlus(object):
-    def __init__(self, stim, params, function=weibull):
+    '''Bayesian adaptive procedure (Watson, 2017) for psychometric function
+    with two response outcomes.
+
+    Parameters
+    ----------
+    stim : 1d array
+        Stimulus domain - contrast values that can be presented.
+    params : list of 1d arrays | 1d array
+        Model parameter domain. If list - all combinations of the parameter
+        values are used.
+    function : callable
+        Psychometric function ``function(stim, params)`` returning the
+        probability of correct response.
+    cache_dir : str | None
+        Directory for caching the likelihood table (and the table of
+        response entropies derived from it). If given, the tables are
+        stored there as ``.npy`` files keyed by the stimulus and parameter
+        domains and the psychometric function. Later instances with the same
+        setup memory-map the tables instead of recomputing them. Defaults to
+        ``None`` - no caching.
+    log_space : bool
+        Whether to keep the posterior as unnormalized log-probabilities.
+        Updates then only add log-likelihoods and the posterior is
+        exponentiated and normalized (with log-sum-exp) only when it is
+        needed. This avoids underflow over long sessions. Defaults to
+        ``False``.
+    prune : float | None
+        Posterior probability below which model parameter combinations are
+        left out when computing expected entropy and parameter estimates.
+        The full posterior is still updated on every trial so combinations
+        that regain probability above ``prune`` are taken into account
+        again. Defaults to ``None`` - no pruning.
+    max_support : float
+        Largest fraction of model parameter combinations in the support for
+        which ``next_contrast`` gathers the likelihood table on the support.
+        Gathering is slower than using the full table unless the support is
+        small, so for larger supports the full table is used. Defaults to
+        ``0.1``.
+    dtype : str | numpy dtype
+        Floating point type of the likelihood table, the posterior and
+        expected entropy computations. ``'float32'`` halves memory and
+        memory bandwidth; use ``check_dtype_accuracy`` to compare it with
+        ``'float64'`` on recorded sessions. Defaults to ``'float64'``.
+    '''
+    def __init__(self, stim, params, function=weibull, cache_dir=None,
+                 log_space=False, prune=None, max_support=0.1,
+                 dtype='float64'):
         self.function = function
+        self.dtype = np.dtype(dtype)
+        self.log_space = log_space
+        self.prune = prune
+        self.max_support = max_support
+        self._posterior = None
+        self._log_posterior = None
         self.stim_domain = stim
         self.param_domain = reformat_params(params)
 
@@ -195,23 +579,186 @@ class QuestPlus(object):
 
         n_stim, n_param = self.stim_domain.shape[0], self.param_domain.shape[0]
 
-        # setup likelihoods for all combinations
-        # of stimulus and model parameter domains
-        self.likelihoods = np.zeros((n_stim, n_param, 2))
-        for p in range(n_param):
-            self.likelihoods[:, p, 0] = self.function(self.stim_domain,
-                                                      self.param_domain[p, :])
-
-        # assumes (correct, incorrect) responses
-        self.likelihoods[:, :, 1] = 1. - self.likelihoods[:, :, 0]
+        # setup likelihoods of correct response for all combinations of
+        # stimulus and model parameter domains (likelihood of incorrect
+        # response is 1 - likelihood of correct)
+        if cache_dir is None:
+            self.likelihoods = self._build_likelihoods()
+        else:
+            self.likelihoods = self._cached_table(
+                cache_dir, 'likelihoods', self._build_likelihoods)
 
         # we also assume a flat prior (so we init posterior to flat too)
-        self.posterior = np.ones(n_param)
+        self.posterior = np.ones(n_param, dtype=self.dtype)
         self.posterior /= self.posterior.sum()
 
         self.stim_history = list()
         self.resp_history = list()
-        self.entropy = np.ones(n_stim)
+        self.entropy = np.ones(n_stim, dtype=self.dtype)
+
+        # entropy of response outcome for each stimulus and model parameter
+        # combination is built on first use (see _cell_entropy)
+        self._cache_dir = cache_dir
+        self._cell_entropy_table = None
+
+        # work buffers reused by next_contrast
+        self._buffers = _EntropyBuffers(n_stim, n_param, self.dtype)
+
+        # background precomputation of next contrast (see precompute_next)
+        self._precompute_buffers = None
+        self._precompute_thread = None
+        self._precomputed = None
+        self._last_update = None
+
+    @property
+    def posterior(self):
+        '''Normalized posterior probability of model parameters.'''
+        if self._posterior is None:
+            # exponentiate log-posterior only when needed
+            log_post = self._log_posterior
+            self._posterior = np.exp(log_post - log_post.max())
+            self._posterior /= self._posterior.sum()
+        return self._posterior
+
+    @posterior.setter
+    def posterior(self, value):
+        value = np.asarray(value, dtype=self.dtype)
+        self._precomputed = None
+        if self.log_space:
+            with np.errstate(divide='ignore'):
+                self._log_posterior = np.log(value)
+            self._posterior = None
+        else:
+            self._posterior = value
+
+    @property
+    def log_posterior(self):
+        '''Log of the normalized posterior probability.'''
+        if not self.log_space:
+            with np.errstate(divide='ignore'):
+                return np.log(self.posterior)
+        log_post = self._log_posterior
+        max_val = log_post.max()
+        return log_post - (max_val + np.log(np.exp(log_post - max_val).sum()))
+
+    @property
+    def _cell_entropy(self):
+        '''Entropy of response outcome for each stimulus and model parameter
+        combination - this allows to compute expected entropy with simple
+        contractions in next_contrast. Built (or memory-mapped from
+        cache_dir, just like the likelihoods) on first use, so trackers that
+        only update the posterior do not pay for it.'''
+        if self._cell_entropy_table is None:
+            if self._cache_dir is None:
+                self._cell_entropy_table = self._build_cell_entropy()
+            else:
+                self._cell_entropy_table = self._cached_table(
+                    self._cache_dir, 'cell_entropy', self._build_cell_entropy)
+        return self._cell_entropy_table
+
+    @property
+    def support(self):
+        '''Indices of model parameter combinations with posterior
+        probability not lower than ``prune`` (all indices if pruning is not
+        used).'''
+        return self._find_support(self.posterior)
+
+    def _find_support(self, posterior):
+        if self.prune is None:
+            return np.arange(posterior.shape[0])
+        # never prune all parameter combinations
+        threshold = min(self.prune, posterior.max())
+        return np.flatnonzero(posterior >= threshold)
+
+    def _build_likelihoods(self):
+        return self._compute_likelihoods().astype(self.dtype)
+
+    def _build_cell_entropy(self):
+        likelihoods = self.likelihoods
+        return -(xlogy(likelihoods, likelihoods) +
+                 xlogy(1. - likelihoods, 1. - likelihoods))
+
+    def _response_likelihood(self, contrast_idx, resp_idx):
+        '''Likelihood of response for whole model parameter domain.
+        resp_idx is 0 for correct and 1 for incorrect response.'''
+        likelihood = self.likelihoods[contrast_idx]
+        return likelihood if resp_idx == 0 else 1. - likelihood
+
+    def _cache_key(self):
+        '''Hash identifying the likelihood table: stimulus and parameter
+        domains and the psychometric function (with partial arguments).'''
+        hsh = hashlib.sha1()
+        for arr in (self.stim_domain, self.param_domain):
+            arr = np.ascontiguousarray(arr, dtype='float64')
+            hsh.update(str(arr.shape).encode('utf-8'))
+            hsh.update(arr.tobytes())
+        hsh.update(_function_key(self.function).encode('utf-8'))
+        hsh.update(self.dtype.str.encode('utf-8'))
+        hsh.update(b'p_correct')
+        return hsh.hexdigest()
+
+    def _cached_table(self, cache_dir, name, build):
+        '''Memory-map (n_stim, n_param) table from cache_dir, computing it
+        with ``build`` and storing it first if it is not present.'''
+        n_stim, n_param = self.stim_domain.shape[0], self.param_domain.shape[0]
+        fname = os.path.join(cache_dir, 'quest_plus_{}_{}.npy'.format(
+            name, self._cache_key()))
+        if os.path.isfile(fname):
+            try:
+                table = np.load(fname, mmap_mode='r')
+                if table.shape == (n_stim, n_param):
+                    return table
+            except (IOError, ValueError):
+                pass
+
+        # compute and save to temporary file first, so that other processes
+        # never see partially written table
+        table = build()
+        tmp_fname = fname + '.{}.tmp'.format(os.getpid())
+        with open(tmp_fname, 'wb') as f:
+            np.save(f, table)
+        try:
+            if os.path.isfile(fname):
+                os.remove(fname)
+            os.rename(tmp_fname, fname)
+        except OSError:
+            # other process saved the table in the meantime
+            os.remove(tmp_fname)
+        return np.load(fname, mmap_mode='r')
+
+    def _compute_likelihoods(self):
+        '''Evaluate psychometric function for all combinations of stimulus
+        and model parameter values.
+
+        The function is first called once with stimulus values as a column
+        and each parameter as a row so that it broadcasts to the whole
+        (n_stim, n_param) grid. If the function does not support such
+        broadcasting it is evaluated separately for each parameter
+        combination.
+
+        Returns
+        -------
+        likelihoods : 2d array
+            Probability of correct response, shape (n_stim, n_param).
+        '''
+        n_stim, n_param = self.stim_domain.shape[0], self.param_domain.shape[0]
+        stim = np.asarray(self.stim_domain)[:, np.newaxis]
+        params = self.param_domain.T[:, np.newaxis, :]
+        try:
+            with np.errstate(all='ignore'):
+                likelihoods = np.asarray(self.function(stim, params),
+                                         dtype='float64')
+            if likelihoods.shape == (n_stim, n_param):
+                return likelihoods
+        except (ValueError, TypeError, IndexError):
+            pass
+
+        # fallback for functions that do not broadcast
+        likelihoods = np.zeros((n_stim, n_param))
+        for p in range(n_param):
+            likelihoods[:, p] = self.function(self.stim_domain,
+                                              self.param_domain[p, :])
+        return likelihoods
 
     def update(self, contrast, ifcorrect, approximate=False):
         '''update posterior probability with outcome of current trial.
@@ -227,13 +774,22 @@ class QuestPlus(object):
             contrast,  approximate=approximate)[0]
 
         # take likelihood of such resp for whole model parameter domain
-        likelihood = self.likelihoods[contrast_idx, :, resp_idx]
-        self.posterior *= likelihood
-        self.posterior /= self.posterior.sum()
+        likelihood = self._response_likelihood(contrast_idx, resp_idx)
+        if self.log_space:
+            with np.errstate(divide='ignore'):
+                self._log_posterior += np.log(likelihood)
+            self._posterior = None
+        else:
+            # update in place - assigning to self.posterior would discard
+            # the precomputed next contrast
+            posterior = self._posterior
+            posterior *= likelihood
+            posterior /= posterior.sum()
 
         # log history of contrasts and responses
         self.stim_history.append(contrast)
         self.resp_history.append(ifcorrect)
+        self._last_update = (len(self.stim_history), contrast_idx, resp_idx)
 
     def _find_contrast_index(self, contrast, approximate=False):
         contrast = np.atleast_1d(contrast)
@@ -251,44 +807,287 @@ class QuestPlus(object):
 
         Expected entropy is updated in self.entropy.
 
+        Parameters
+        ----------
+        axis : int | list of int | None
+            Model parameter axis (or axes) whose marginal posterior entropy
+            should be minimized. For example ``axis=0`` targets threshold
+            uncertainty only. Defaults to ``None`` - entropy of the joint
+            posterior of all parameters.
+
         Returns
         -------
         contrast : contrast value for the next trial.'''
-        full_posterior = self.likelihoods * self.posterior[
-            np.newaxis, :, np.newaxis]
-        if axis is not None:
-            shp = full_posterior.shape
-            new_shape = [shp[0]] + self._orig_param_shape + [shp[-1]]
-            full_posterior = full_posterior.reshape(new_shape)
-            reduce_axes = np.arange(len(self._orig_param_shape)) + 1
-            reduce_axes = tuple(np.delete(reduce_axes, axis))
-            full_posterior = full_posterior.sum(axis=reduce_axes)
-
-        norm = full_posterior.sum(axis=1, keepdims=True)
-        full_posterior /= norm
-
-        H = -np.nansum(full_posterior * np.log(full_posterior), axis=1)
-        self.entropy = (norm[:, 0, :] * H).sum(axis=1)
+        axis = _normalize_axis(axis)
+        if self._precomputed is not None:
+            entropy = self._take_precomputed(axis)
+            if entropy is not None:
+                self.entropy[:] = entropy
+                return self.stim_domain[self.entropy.argmin()]
+
+        if axis is None:
+            likelihoods, cell_entropy, posterior = self._active_tables(
+                self.posterior, self._buffers)
+            self._expected_entropy(likelihoods, cell_entropy, posterior,
+                                   self._buffers, out=self.entropy)
+        else:
+            self._expected_marginal_entropy(self.posterior, axis,
+                                            out=self.entropy)
 
         # choose contrast with minimal entropy
         return self.stim_domain[self.entropy.argmin()]
 
-    # TODO:
-    # - [ ] check correctness
-    def compute_entropy(self, contrasts):
-        '''Compute entropy for a sequence of contrasts.'''
+    def precompute_next(self, contrast, approximate=False, axis=None):
+        '''Start computing next contrast for both possible responses to
+        a trial with given contrast.
+
+        Computation runs in a background thread (numpy releases the GIL), so
+        it can be started just before presenting the trial. After the trial
+        call ``update`` as usual - the following ``next_contrast`` call then
+        only picks the precomputed contrast for the given response.
+
+        Parameters
+        ----------
+        contrast : float
+            Contrast value of the trial that is about to be presented.
+        approximate : bool
+            Whether to use the nearest contrast from stimulus domain (see
+            ``update``).
+        axis : int | list of int | None
+            Model parameter axis to target (see ``next_contrast``).
+        '''
+        axis = _normalize_axis(axis)
+        contrast_idx = self._find_contrast_index(
+            contrast, approximate=approximate)[0]
+
+        # previous precomputation (even if its result was discarded) may
+        # still use the buffers
+        if self._precompute_thread is not None:
+            self._precompute_thread.join()
+            self._precompute_thread = None
+        if axis is None:
+            # build outcome entropy here, not in the background thread
+            self._cell_entropy
+        if self._precompute_buffers is None:
+            n_stim, n_param = self.likelihoods.shape
+            self._precompute_buffers = _EntropyBuffers(n_stim, n_param,
+                                                       self.dtype)
+
+        result = dict(key=(len(self.stim_history) + 1, contrast_idx),
+                      axis=axis, entropy=dict(), error=None)
+        thread = threading.Thread(
+            target=self._precompute_worker,
+            args=(self.posterior.copy(), contrast_idx, axis, result))
+        thread.daemon = True
+        result['thread'] = thread
+        self._precomputed = result
+        self._precompute_thread = thread
+        thread.start()
+
+    def _precompute_worker(self, posterior, contrast_idx, axis, result):
+        try:
+            buffers = self._precompute_buffers
+            for resp_idx in (0, 1):
+                this_posterior = posterior * self._response_likelihood(
+                    contrast_idx, resp_idx)
+                this_posterior /= this_posterior.sum()
+                out = np.zeros(self.entropy.shape[0], dtype=self.dtype)
+                if axis is None:
+                    tables = self._active_tables(this_posterior, buffers)
+                    self._expected_entropy(*tables, buffers=buffers, out=out)
+                else:
+                    self._expected_marginal_entropy(this_posterior, axis,
+                                                    out=out)
+                result['entropy'][resp_idx] = out
+        except Exception as err:
+            result['error'] = err
+
+    def _take_precomputed(self, axis):
+        '''Return precomputed expected entropy if it matches the last
+        update, None otherwise.'''
+        result, self._precomputed = self._precomputed, None
+        result['thread'].join()
+        last_update = self._last_update
+        if (result['error'] is not None or last_update is None or
+                result['key'] != last_update[:2] or result['axis'] != axis):
+            return None
+        return result['entropy'][last_update[2]]
+
+    def _active_tables(self, posterior, buffers):
+        '''Likelihoods, outcome entropy and posterior restricted to the
+        support of the posterior. When pruning and the support is not larger
+        than ``max_support`` the tables are gathered into preallocated
+        buffers.'''
+        if self.prune is None:
+            return self.likelihoods, self._cell_entropy, posterior
+
+        n_stim, n_param = self.likelihoods.shape
+        support = self._find_support(posterior)
+        n_sup = support.shape[0]
+        max_sup = int(np.ceil(self.max_support * n_param))
+        if n_sup > max_sup:
+            return self.likelihoods, self._cell_entropy, posterior
+
+        lik_buf, ent_buf, post_buf = buffers.support_buffers(max_sup)
+        likelihoods = lik_buf[:n_stim * n_sup].reshape(n_stim, n_sup)
+        cell_entropy = ent_buf[:n_stim * n_sup].reshape(n_stim, n_sup)
+        np.take(self.likelihoods, support, axis=1, out=likelihoods,
+                mode='clip')
+        np.take(self._cell_entropy, support, axis=1, out=cell_entropy,
+                mode='clip')
+        posterior = np.take(posterior, support, out=post_buf[:n_sup],
+                            mode='clip')
+        return likelihoods, cell_entropy, posterior
+
+    def _expected_entropy(self, likelihoods, cell_entropy, posterior,
+                          buffers, out):
+        '''Expected entropy of the posterior after presenting each stimulus.
+
+        Uses the decomposition:
+        E[H] = sum_r n_r log(n_r) + sum_p h_p P(p) - sum_p P(p) log(P(p))
+        where n_r is the probability of response r and h_p is the entropy of
+        the response for model parameters p - so no temporary of the size of
+        the likelihood table is needed. Probability of incorrect response is
+        derived from probability of correct response.
+        '''
+        n_param = posterior.shape[0]
+        norm, xlogx_norm = buffers.norm, buffers.xlogx_norm
+
+        # probability of each response outcome for each stimulus
+        np.dot(likelihoods, posterior, out=norm[0])
+        np.subtract(posterior.sum(), norm[0], out=norm[1])
+        xlogy(norm, norm, out=xlogx_norm)
+
+        # expected entropy
+        np.dot(cell_entropy, posterior, out=out)
+        np.add(out, xlogx_norm[0], out=out)
+        np.add(out, xlogx_norm[1], out=out)
+        post_buf = buffers.param[:n_param]
+        out -= xlogy(posterior, posterior, out=post_buf).sum()
+        return out
+
+    def _expected_marginal_entropy(self, posterior, axis, out):
+        '''Expected entropy of the marginal posterior of chosen model
+        parameter axes after presenting each stimulus.
+
+        The joint of correct response and marginal parameters is obtained
+        with one tensor contraction of the likelihood table and the
+        posterior, the joint for incorrect response is the marginal
+        posterior minus that.
+        '''
+        shape = list(self._orig_param_shape)
+        n_stim, n_dim = self.likelihoods.shape[0], len(shape)
+        other_axes = tuple(ax for ax in range(n_dim) if ax not in axis)
+
+        posterior = posterior.reshape(shape)
+        likelihoods = self.likelihoods.reshape([n_stim] + shape)
+        param_sub = list(range(1, n_dim + 1))
+        joint_correct = np.einsum(likelihoods, [0] + param_sub,
+                                  posterior, param_sub,
+                                  [0] + [ax + 1 for ax in axis])
+        joint_correct = joint_correct.reshape(n_stim, -1)
+        marginal = posterior.sum(axis=other_axes).reshape(1, -1)
+        joint_incorrect = marginal - joint_correct
+
+        norm_correct = joint_correct.sum(axis=1)
+        norm_incorrect = marginal.sum() - norm_correct
+        out[:] = (xlogy(norm_correct, norm_correct) +
+                  xlogy(norm_incorrect, norm_incorrect) -
+                  xlogy(joint_correct, joint_correct).sum(axis=1) -
+                  xlogy(joint_incorrect, joint_incorrect).sum(axis=1))
+        return out
+
+    def compute_entropy(self, contrasts, approximate=False,
+                        max_cells=2 ** 24):
+        '''Compute expected posterior entropy after a block of trials.
+
+        All 2 ** n_trials response sequences are taken into account. Many
+        blocks can be scored at once by passing a 2d array.
+
+        Parameters
+        ----------
+        contrasts : 1d or 2d array
+            Contrasts of one block of trials or array of candidate blocks
+            of shape (n_blocks, n_trials).
+        approximate : bool
+            Whether to use the nearest contrasts from stimulus domain.
+        max_cells : int
+            Maximum number of elements of temporary arrays - blocks are
+            processed in chunks that do not exceed this size.
 
-        contrast_idx = self._find_contrast_index(contrasts)
-        agg_posterior = (np.ones(self.likelihoods[0].shape) *
-                         self.posterior[:, np.newaxis])
-        for idx in contrast_idx:
-            agg_posterior *= self.likelihoods[idx]
-        norm = agg_posterior.sum(axis=0, keepdims=True)
-        agg_posterior /= norm
+        Returns
+        -------
+        entropy : float | 1d array
+            Expected entropy for the block (or for each block if
+            ``contrasts`` was 2d).
+        '''
+        contrasts = np.asarray(contrasts)
+        blocks = np.atleast_2d(contrasts)
+        n_blocks, n_trials = blocks.shape
+        contrast_idx = np.reshape(self._find_contrast_index(
+            blocks.ravel(), approximate=approximate), blocks.shape)
+
+        support = self.support
+        posterior = self.posterior[support]
+        likelihoods = self.likelihoods[:, support]
+        cell_entropy = self._cell_entropy[:, support]
+
+        # response entropy of independent trials adds up, so only the
+        # probabilities of response sequences need the full expansion:
+        # E[H] = sum_o n_o log(n_o) + sum_t sum_p h_tp P(p) - H(P)
+        entropy = (cell_entropy.dot(posterior)[contrast_idx].sum(axis=1) -
+                   xlogy(posterior, posterior).sum())
+
+        n_outcomes = 2 ** n_trials
+        chunk = max(1, int(max_cells // (n_outcomes * len(support))))
+        for start in range(0, n_blocks, chunk):
+            idx = contrast_idx[start:start + chunk]
+            # likelihood of each response sequence: (block, sequence, param)
+            seq_lik = np.ones((idx.shape[0], 1, len(support)),
+                              dtype=self.dtype)
+            for trial in range(n_trials - 1):
+                lik = likelihoods[idx[:, trial]][:, np.newaxis, :]
+                seq_lik = np.concatenate([seq_lik * lik,
+                                          seq_lik * (1. - lik)], axis=1)
+
+            # the last trial does not need to be expanded: probability of
+            # incorrect response is the rest of the sequence probability
+            seq_lik *= posterior
+            norm_correct = np.einsum('bop,bp->bo', seq_lik,
+                                     likelihoods[idx[:, -1]])
+            norm_incorrect = seq_lik.sum(axis=-1) - norm_correct
+            entropy[start:start + chunk] += (
+                xlogy(norm_correct, norm_correct).sum(axis=1) +
+                xlogy(norm_incorrect, norm_incorrect).sum(axis=1))
+
+        return entropy if contrasts.ndim > 1 else entropy[0]
+
+    def plan_block(self, candidates, approximate=False, max_cells=2 ** 24):
+        '''Choose block of trials that minimizes expected posterior
+        entropy.
+
+        Expected entropy of all candidates is stored in
+        ``self.block_entropy``.
+
+        Parameters
+        ----------
+        candidates : 2d array
+            Candidate blocks of contrasts, shape (n_blocks, n_trials). See
+            ``block_candidates``.
+        approximate : bool
+            Whether to use the nearest contrasts from stimulus domain.
+        max_cells : int
+            Maximum number of elements of temporary arrays.
 
-        H = -np.nansum(agg_posterior * np.log(agg_posterior), axis=0)
-        entropy = (norm[0, :] * H).sum()
-        return entropy
+        Returns
+        -------
+        block : 1d array
+            Contrasts of the best block.
+        '''
+        candidates = np.atleast_2d(candidates)
+        self.block_entropy = self.compute_entropy(
+            candidates, approximate=approximate, max_cells=max_cells)
+        return candidates[self.block_entropy.argmin()]
 
     def get_posterior(self):
     	return self.posterior.reshape(self._orig_param_shape)
@@ -299,17 +1098,32 @@ class QuestPlus(object):
             return self.param_domain[self.posterior.argmax(), :]
         elif select == 'mean':
             # parameters weighted by their probability
-            return (self.posterior[:, np.newaxis] *
-                    self.param_domain).sum(axis=0)
+            support = self.support
+            posterior = self.posterior[support]
+            return (posterior[:, np.newaxis] * self.param_domain[support]
+                    ).sum(axis=0) / posterior.sum()
         elif select == 'ML':
+            # maximum likelihood fit starting from the posterior mode
             if weibull_args is None:
-                weibull_args = dict(kind='weibull_db')
+                weibull_args = self._weibull_args()
             w = Weibull(**weibull_args)
             init_params = self.get_fit_params(select='max')
             w.fit(np.array(self.stim_history), np.array(self.resp_history),
                            init_params)
             return w.params
 
+    def _weibull_args(self):
+        '''Weibull arguments matching the psychometric function used.'''
+        fun, keywords = self.function, dict()
+        if isinstance(fun, partial):
+            fun, keywords = fun.func, fun.keywords or dict()
+        if fun is weibull_db:
+            return dict(kind='weibull_db')
+        weibull_args = dict(kind='weibull')
+        if 'corr_at_thresh' in keywords:
+            weibull_args['corr_at_thresh'] = keywords['corr_at_thresh']
+        return weibull_args
+
     def fit(self, contrasts, responses, approximate=False):
         for contrast, response in zip(contrasts, responses):
             self.update(contrast, response, approximate=approximate)
@@ -319,6 +1133,295 @@ class QuestPlus(object):
         return plot_quest_plus(self)
 
 
+def block_candidates(contrasts, n_trials):
+    '''All blocks of ``n_trials`` trials using given contrasts
+    (combinations with repetition - order of trials is not relevant for
+    expected entropy).
+
+    Returns
+    -------
+    candidates : 2d array
+        Array of shape (n_blocks, n_trials).
+    '''
+    return np.array(list(combinations_with_replacement(contrasts, n_trials)))
+
+
+def _normalize_axis(axis):
+    '''Turn model parameter axis specification to a sorted tuple.'''
+    if axis is None:
+        return None
+    return tuple(sorted(int(ax) for ax in np.atleast_1d(axis)))
+
+
+class _EntropyBuffers(object):
+    '''Work buffers used by QuestPlus when computing expected entropy.'''
+    def __init__(self, n_stim, n_param, dtype='float64'):
+        self.n_stim = n_stim
+        self.n_param = n_param
+        self.dtype = dtype
+        self.norm = np.zeros((2, n_stim), dtype=dtype)
+        self.xlogx_norm = np.zeros((2, n_stim), dtype=dtype)
+        self.param = np.zeros(n_param, dtype=dtype)
+        self._support = None
+
+    def support_buffers(self, max_support):
+        '''Buffers for likelihoods, outcome entropy and posterior gathered
+        on the posterior support of at most ``max_support`` model parameter
+        combinations (allocated on first use).'''
+        if self._support is None or self._support[2].shape[0] < max_support:
+            n_cells = self.n_stim * max_support
+            self._support = (np.zeros(n_cells, dtype=self.dtype),
+                             np.zeros(n_cells, dtype=self.dtype),
+                             np.zeros(max_support, dtype=self.dtype))
+        return self._support
+
+
+def _function_key(fun):
+    '''Text description of a psychometric function used for caching.'''
+    if isinstance(fun, partial):
+        return '{}(args={!r}, kwargs={!r})'.format(
+            _function_key(fun.func), _value_key(fun.args),
+            _value_key(sorted(fun.keywords.items())))
+    name = '{}.{}'.format(getattr(fun, '__module__', ''),
+                          getattr(fun, '__name__', repr(fun)))
+    code = getattr(fun, '__code__', None)
+    if code is not None:
+        # include code, constants, defaults and closure values so that
+        # editing the function invalidates cached tables
+        name += _code_key(code)
+        name += _value_key(getattr(fun, '__defaults__', None))
+        name += _value_key(getattr(fun, '__kwdefaults__', None))
+        closure = getattr(fun, '__closure__', None) or ()
+        name += _value_key([cell.cell_contents for cell in closure])
+    return name
+
+
+def _code_key(code):
+    '''Hash of a code object: bytecode, used names and constants (nested
+    code objects, like lambdas, are hashed recursively).'''
+    hsh = hashlib.sha1(code.co_code)
+    hsh.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            hsh.update(_code_key(const).encode('utf-8'))
+        else:
+            hsh.update(repr(const).encode('utf-8'))
+    return hsh.hexdigest()
+
+
+def _value_key(value):
+    '''Text description of argument, default or closure values.'''
+    if isinstance(value, np.ndarray):
+        return 'array({}, {}, {})'.format(
+            value.shape, value.dtype.str,
+            hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return '({})'.format(', '.join(_value_key(val) for val in value))
+    if isinstance(value, dict):
+        return _value_key(sorted(value.items()))
+    if callable(value) and (hasattr(value, '__code__') or
+                            isinstance(value, partial)):
+        return _function_key(value)
+    return repr(value)
+
+
+class BatchQuestPlus(object):
+    '''Quest+ for many observers at once - useful for simulations.
+
+    All observers share stimulus and parameter domains (and the likelihood
+    table) while each has its own posterior, so posteriors are kept as one
+    (n_observers, n_param) array. Memory needed for the posteriors grows
+    with ``n_observers * n_param`` - for very large simulations run several
+    batches (or use ``dtype='float32'``).
+
+    Parameters
+    ----------
+    stim : 1d array
+        Stimulus domain.
+    params : list of 1d arrays | 1d array
+        Model parameter domain.
+    n_observers : int
+        Number of observers.
+    function : callable
+        Psychometric function.
+    cache_dir : str | None
+        Directory for caching the likelihood table (see ``QuestPlus``).
+    dtype : str | numpy dtype
+        Floating point type of the tables and posteriors.
+    max_cells : int
+        Maximum number of elements of temporary arrays created when
+        updating posteriors and computing expected entropy - observers are
+        processed in chunks that do not exceed this size.
+
+    example:
+    --------
+    bqp = BatchQuestPlus(stim, [thresholds, slopes, lapses], 1000)
+    contrasts = bqp.next_contrast()
+    bqp.update(contrasts, responses)
+    '''
+    def __init__(self, stim, params, n_observers, function=weibull,
+                 cache_dir=None, dtype='float64', max_cells=2 ** 24):
+        self._qp = QuestPlus(stim, params, function=function,
+                             cache_dir=cache_dir, dtype=dtype)
+        self.function = function
+        self.stim_domain = self._qp.stim_domain
+        self.param_domain = self._qp.param_domain
+        self.likelihoods = self._qp.likelihoods
+        self.dtype = self._qp.dtype
+        self.n_observers = n_observers
+        self.max_cells = max_cells
+
+        n_stim, n_param = self.likelihoods.shape
+        self.posterior = np.tile(self._qp.posterior, (n_observers, 1))
+        self.entropy = np.ones((n_observers, n_stim), dtype=self.dtype)
+        self.stim_history = list()
+        self.resp_history = list()
+
+    def set_prior(self, prior):
+        '''Set the same prior (1d, n_param) or separate priors
+        (2d, n_observers x n_param) for all observers.'''
+        prior = np.asarray(prior, dtype=self.dtype)
+        self.posterior[:] = prior / prior.sum(axis=-1, keepdims=True)
+
+    def _find_contrast_index(self, contrasts, approximate=False):
+        contrasts = np.asarray(contrasts)
+        idx = np.abs(self.stim_domain[np.newaxis, :] -
+                     contrasts[:, np.newaxis]).argmin(axis=1)
+        if not approximate and not (self.stim_domain[idx] == contrasts).all():
+            raise ValueError('Some contrasts are not in the stimulus domain, '
+                             'use approximate=True.')
+        return idx
+
+    def update(self, contrasts, ifcorrect, approximate=False):
+        '''Update posteriors of all observers with outcome of current trial.
+
+        contrasts - contrast value for each observer
+        ifcorrect - whether response of each observer was correct
+        '''
+        contrasts = np.broadcast_to(contrasts, (self.n_observers,))
+        ifcorrect = np.broadcast_to(ifcorrect, (self.n_observers,))
+        contrast_idx = self._find_contrast_index(contrasts,
+                                                 approximate=approximate)
+
+        # observers are processed in chunks of at most max_cells, gathering
+        # likelihoods into a reused buffer
+        n_param = self.likelihoods.shape[1]
+        chunk = min(self.n_observers, max(1, int(self.max_cells // n_param)))
+        likelihood = np.empty((chunk, n_param), dtype=self.dtype)
+        incorrect = ~ifcorrect.astype('bool')
+        for start in range(0, self.n_observers, chunk):
+            stop = min(start + chunk, self.n_observers)
+            this_likelihood = likelihood[:stop - start]
+            np.take(self.likelihoods, contrast_idx[start:stop], axis=0,
+                    out=this_likelihood)
+            this_incorrect = incorrect[start:stop]
+            this_likelihood[this_incorrect] = (
+                1. - this_likelihood[this_incorrect])
+            posterior = self.posterior[start:stop]
+            posterior *= this_likelihood
+            posterior /= posterior.sum(axis=1, keepdims=True)
+
+        self.stim_history.append(np.array(contrasts))
+        self.resp_history.append(np.array(ifcorrect))
+
+    def next_contrast(self):
+        '''Get contrast minimizing expected entropy for each observer.
+
+        Expected entropy is updated in self.entropy.
+
+        Returns
+        -------
+        contrasts : 1d array
+            Contrast value for the next trial of each observer.'''
+        n_param = self.likelihoods.shape[1]
+        cell_entropy = self._qp._cell_entropy
+        chunk = max(1, int(self.max_cells // n_param))
+        for start in range(0, self.n_observers, chunk):
+            posterior = self.posterior[start:start + chunk]
+            # see QuestPlus._expected_entropy
+            norm = posterior.dot(self.likelihoods.T)
+            norm_incorrect = posterior.sum(axis=1, keepdims=True) - norm
+            self.entropy[start:start + chunk] = (
+                posterior.dot(cell_entropy.T) + xlogy(norm, norm) +
+                xlogy(norm_incorrect, norm_incorrect) -
+                xlogy(posterior, posterior).sum(axis=1, keepdims=True))
+        return self.stim_domain[self.entropy.argmin(axis=1)]
+
+    def get_fit_params(self, select='mode'):
+        '''Parameters for each observer (n_observers x n_params).'''
+        if select in ['max', 'mode']:
+            return self.param_domain[self.posterior.argmax(axis=1), :]
+        elif select == 'mean':
+            return self.posterior.dot(self.param_domain)
+
+    def fit(self, contrasts, responses, approximate=False):
+        '''Update with trials of shape (n_trials, n_observers).'''
+        for contrast, response in zip(contrasts, responses):
+            self.update(contrast, response, approximate=approximate)
+
+
+def check_dtype_accuracy(stim, params, contrasts, responses, function=weibull,
+                         dtype='float32', approximate=True, **qp_args):
+    '''Compare QuestPlus run in lower precision with float64 version on
+    recorded trials.
+
+    Both trackers are updated with the same recorded contrasts and
+    responses. After each trial posteriors, expected entropies and chosen
+    next contrasts are compared.
+
+    Parameters
+    ----------
+    stim : 1d array
+        Stimulus domain.
+    params : list of 1d arrays
+        Model parameter domain.
+    contrasts : array of float
+        Recorded contrasts, for example ``df.opacity.values``.
+    responses : array of int
+        Recorded correctness, for example ``df.ifcorrect.values``.
+    function : callable
+        Psychometric function.
+    dtype : str | numpy dtype
+        Precision to test. Defaults to ``'float32'``.
+    approximate : bool
+        Whether recorded contrasts should be matched to the nearest stimulus
+        domain value.
+    **qp_args :
+        Additional arguments passed to both QuestPlus objects.
+
+    Returns
+    -------
+    accuracy : dict
+        ``'max_posterior_diff'`` - maximum absolute posterior difference,
+        ``'max_entropy_diff'`` - maximum absolute expected entropy
+        difference, ``'max_param_diff'`` - maximum absolute difference of
+        posterior-mean parameters, ``'contrast_agreement'`` - proportion of
+        trials where both trackers chose the same next contrast.
+    '''
+    qp_ref = QuestPlus(stim, params, function=function, dtype='float64',
+                       **qp_args)
+    qp_test = QuestPlus(stim, params, function=function, dtype=dtype,
+                        **qp_args)
+
+    max_post, max_ent, max_param, n_same = 0., 0., 0., 0
+    for contrast, response in zip(contrasts, responses):
+        qp_ref.update(contrast, response, approximate=approximate)
+        qp_test.update(contrast, response, approximate=approximate)
+        n_same += qp_ref.next_contrast() == qp_test.next_contrast()
+        max_post = max(max_post, np.abs(qp_ref.posterior -
+                                        qp_test.posterior).max())
+        max_ent = max(max_ent, np.abs(qp_ref.entropy -
+                                      qp_test.entropy).max())
+        max_param = max(max_param, np.abs(
+            qp_ref.get_fit_params(select='mean') -
+            qp_test.get_fit_params(select='mean')).max())
+
+    return dict(max_posterior_diff=float(max_post),
+                max_entropy_diff=float(max_ent),
+                max_param_diff=float(max_param),
+                contrast_agreement=n_same / float(max(len(contrasts), 1)))
+
+
 def init_thresh_optim(df, qp, model_params, logger=None):
     '''Initialize threshold optimization.
 